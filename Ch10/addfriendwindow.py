@@ -8,31 +8,139 @@ class AddFriendWindow(tk.Toplevel):
         self.master = master
 
         self.transient(master)
-        self.geometry("250x100")
+        self.geometry("300x340")
         self.title("Add a Friend")
 
+        # redraw every this many users so the first results appear before the page finishes
+        self.rows_per_update = 20
+        self.next_cursor = None
+        self.query = ""
+        self.search_id = 0
+
         main_frame = ttk.Frame(self)
 
         username_label = ttk.Label(main_frame, text="Username")
         self.username_entry = ttk.Entry(main_frame)
+        self.username_entry.bind("<Return>", self.search_users)
+
+        search_button = ttk.Button(main_frame, text="Search", command=self.search_users)
+
+        results_frame = ttk.Frame(main_frame)
+        self.results = tk.Listbox(results_frame, height=10)
+        scrollbar = ttk.Scrollbar(results_frame, orient=tk.VERTICAL, command=self.results.yview)
+        self.results.configure(yscrollcommand=scrollbar.set)
+        self.results.bind("<<ListboxSelect>>", self.choose_user)
 
+        self.results.pack(side=tk.LEFT, fill=tk.BOTH, expand=1)
+        scrollbar.pack(side=tk.RIGHT, fill=tk.Y)
+
+        self.more_button = ttk.Button(main_frame, text="More", command=self.load_more_users, state=tk.DISABLED)
         add_button = ttk.Button(main_frame, text="Add", command=self.add_friend)
+        self.status = ttk.Label(main_frame, text="")
 
         username_label.grid(row=0, column=0)
         self.username_entry.grid(row=0, column=1)
+        search_button.grid(row=0, column=2)
         self.username_entry.focus_force()
 
-        add_button.grid(row=1, column=0, columnspan=2)
+        results_frame.grid(row=1, column=0, columnspan=3, sticky="nsew")
+        self.more_button.grid(row=2, column=0, columnspan=3)
+        add_button.grid(row=3, column=0, columnspan=3)
+        self.status.grid(row=4, column=0, columnspan=3)
 
-        for i in range(2):
+        for i in range(3):
             tk.Grid.columnconfigure(main_frame, i, weight=1)
-            tk.Grid.rowconfigure(main_frame, i, weight=1)
+        tk.Grid.rowconfigure(main_frame, 1, weight=1)
 
         main_frame.pack(fill=tk.BOTH, expand=1)
 
+        self.usernames = []
+
+    def search_users(self, event=None):
+        self.results.delete(0, tk.END)
+        self.usernames = []
+        self.next_cursor = None
+        self.query = self.username_entry.get()
+        # rows still arriving for an earlier search are dropped
+        self.search_id += 1
+
+        self.show_users(after=None)
+
+    def load_more_users(self):
+        self.show_users(after=self.next_cursor)
+
+    def show_users(self, after):
+        self.more_button.configure(state=tk.DISABLED)
+        self.status.configure(text="Searching...")
+
+        search_id = self.search_id
+        self.master.executor.submit(
+            self.stream_users, search_id, self.query, after,
+            on_success=lambda next_cursor: self.users_loaded(search_id, next_cursor),
+            on_error=lambda error: self.users_failed(search_id, error),
+        )
+
+    def stream_users(self, search_id, query, after):
+        """ Runs on a worker thread, so it hands rows to the main loop in batches rather than touching the Listbox """
+        rows = []
+        next_cursor = None
+
+        for row in self.master.requester.get_all_users(query, after):
+            if "next" in row:
+                next_cursor = row["next"]
+                continue
+
+            rows.append(row)
+            if len(rows) == self.rows_per_update:
+                self.master.executor.report(self.add_users, search_id, rows)
+                rows = []
+
+        if rows:
+            self.master.executor.report(self.add_users, search_id, rows)
+
+        return next_cursor
+
+    def add_users(self, search_id, rows):
+        # the window may have been closed, or a new search started, while the page was arriving
+        if search_id != self.search_id or not self.winfo_exists():
+            return
+
+        for row in rows:
+            self.usernames.append(row["username"])
+            self.results.insert(tk.END, f"{row['username']} ({row['real_name']})")
+
+    def users_loaded(self, search_id, next_cursor):
+        if search_id != self.search_id or not self.winfo_exists():
+            return
+
+        self.status.configure(text="" if self.usernames else "No users found")
+        self.next_cursor = next_cursor
+        if self.next_cursor:
+            self.more_button.configure(state=tk.NORMAL)
+
+    def users_failed(self, search_id, error):
+        if search_id != self.search_id or not self.winfo_exists():
+            return
+
+        self.status.configure(text=f"Could not search: {error}")
+        # next_cursor still points at the page that failed, so More tries it again
+        if self.next_cursor:
+            self.more_button.configure(state=tk.NORMAL)
+
+    def choose_user(self, event=None):
+        selection = self.results.curselection()
+
+        if selection:
+            self.username_entry.delete(0, tk.END)
+            self.username_entry.insert(0, self.usernames[selection[0]])
+
     def add_friend(self):
         username = self.username_entry.get()
 
         if username:
-            if self.master.add_friend(username):
-                self.username_entry.delete(0, tk.END)
+            self.master.add_friend(username, on_added=self.friend_added)
+
+    def friend_added(self):
+        # the window may have been closed while the request was out
+        if self.winfo_exists():
+            self.username_entry.delete(0, tk.END)
@@ -0,0 +1,154 @@
+import os
+import threading
+import tkinter as tk
+
+from collections import OrderedDict
+
+avatar_cache_dir = os.path.abspath(os.path.join(os.path.dirname(__file__), "images/friends"))
+default_avatar_path = os.path.abspath(os.path.join(os.path.dirname(__file__), "images/default.png"))
+
+
+class AvatarCache:
+    """ Friends' avatars keyed by content hash and size, kept as files on disk and as decoded PhotoImages in memory """
+
+    # the size of images/default.png
+    default_size = 128
+
+    def __init__(self, requester, executor, cache_dir=avatar_cache_dir, max_images=100, max_files=1000):
+        self.requester = requester
+        self.executor = executor
+        self.cache_dir = cache_dir
+        self.max_images = max_images
+        self.max_files = max_files
+
+        self.images = OrderedDict()
+        # (hash, size) -> on_fetched callbacks for each download in progress
+        self.fetching = {}
+
+        # downloads finish on several worker threads, so one prunes at a time
+        self.prune_lock = threading.Lock()
+        # counted from the directory once, then kept up to date, so it is only listed again when there are too many
+        self.file_count = None
+
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+    def path_for(self, avatar_hash, size):
+        return os.path.join(self.cache_dir, f"{avatar_hash}-{size}.png")
+
+    def get_path(self, avatar_hash, size=128, on_fetched=None):
+        """ The saved avatar's path, or the default's while it is fetched in the background; on_fetched(path) follows once it is saved """
+        if not avatar_hash:
+            return default_avatar_path
+
+        path = self.path_for(avatar_hash, size)
+
+        try:
+            # the modified time doubles as the last use time for pruning
+            os.utime(path)
+            return path
+        except FileNotFoundError:
+            pass
+
+        self.start_fetch(avatar_hash, size, on_fetched)
+
+        return default_avatar_path
+
+    def start_fetch(self, avatar_hash, size, on_fetched=None):
+        key = (avatar_hash, size)
+
+        # rows scrolling past the same friend share one request rather than sending one each
+        callbacks = self.fetching.get(key)
+        if callbacks is None:
+            callbacks = self.fetching[key] = []
+            self.executor.submit(
+                self.fetch, avatar_hash, size,
+                on_success=lambda path: self.fetched(key, path),
+                # nothing was saved, so the next call tries again; until then the default stays up
+                on_error=lambda error: self.fetching.pop(key, None),
+            )
+
+        if on_fetched:
+            callbacks.append(on_fetched)
+
+    def fetched(self, key, path):
+        for on_fetched in self.fetching.pop(key, []):
+            on_fetched(path)
+
+    def fetch(self, avatar_hash, size):
+        """ Runs on a worker thread, so it only touches files """
+        # raises on an error response, so only real image bytes are ever saved
+        image_bytes = self.requester.get_avatar_image(avatar_hash, size)
+        path = self.path_for(avatar_hash, size)
+
+        # a hash always names the same bytes, so there is never anything to revalidate; the rename keeps half a file from ever existing under its name
+        temp_path = path + ".tmp"
+        with open(temp_path, "wb") as avatar_file:
+            avatar_file.write(image_bytes)
+        os.replace(temp_path, path)
+
+        self.prune_files()
+
+        return path
+
+    def get_image(self, avatar_hash, size=128, on_fetched=None):
+        """ A PhotoImage no bigger than size x size, fetching just that size from the server.
+            Until that arrives it is the default avatar, and on_fetched(image) is called with the real one """
+        key = (avatar_hash or "default", size)
+
+        if key in self.images:
+            self.images.move_to_end(key)
+            return self.images[key]
+
+        on_path_fetched = (lambda path: on_fetched(self.get_image(avatar_hash, size))) if on_fetched else None
+        path = self.get_path(avatar_hash, size, on_path_fetched)
+
+        if avatar_hash and path == default_avatar_path:
+            # still fetching; show the default without keeping it under this hash, so the next call loads the real one
+            return self.get_image(None, size)
+
+        try:
+            image = tk.PhotoImage(file=path)
+        except tk.TclError:
+            if not avatar_hash:
+                raise
+
+            # pruned by a worker since get_path found it, so it has to be fetched again
+            self.start_fetch(avatar_hash, size, on_path_fetched)
+            return self.get_image(None, size)
+
+        if not avatar_hash and size < self.default_size:
+            image = image.subsample(self.default_size // size)
+        self.images[key] = image
+
+        # widgets keep their own reference, so evicting here never blanks a label on screen
+        while len(self.images) > self.max_images:
+            self.images.popitem(last=False)
+
+        return image
+
+    def prune_files(self):
+        """ Runs on a worker thread after each download, removing the least recently used files once there are more than max_files """
+        with self.prune_lock:
+            if self.file_count is None:
+                self.file_count = len(self.cached_files())
+            else:
+                self.file_count += 1
+
+            if self.file_count <= self.max_files:
+                return
+
+            # down to nine tenths, so the directory is listed once every max_files / 10 downloads rather than on each one
+            keep = self.max_files * 9 // 10
+            files = self.cached_files()
+            files.sort(key=os.path.getmtime)
+
+            for path in files[:len(files) - keep]:
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+
+            self.file_count = min(len(files), keep)
+
+    def cached_files(self):
+        return [os.path.join(self.cache_dir, file) for file in os.listdir(self.cache_dir) if file.endswith(".png")]
@@ -1,4 +1,4 @@
-import base64
+import io
 import os
 from PIL import Image
 import tkinter as tk
@@ -7,6 +7,27 @@ from tkinter import filedialog
 
 avatar_file_path = os.path.abspath(os.path.join(os.path.dirname(__file__), "images/avatar.png"))
 
+# the server makes each smaller size from this, so it only needs to be as big as the largest one it serves, with room to spare
+upload_size = (512, 512)
+avatar_size = (128, 128)
+
+
+def prepare_avatar(image_file, size=avatar_size):
+    """ Decodes image_file at no more than the size needed, shrinks it to fit size and returns it as optimized PNG bytes """
+    with Image.open(image_file) as image:
+        # a JPEG decodes straight to 1/2, 1/4 or 1/8 scale, so a 20 MP photo never exists in memory at full size
+        image.draft(image.mode, size)
+
+        if image.mode not in ("RGB", "RGBA"):
+            image = image.convert("RGBA")
+
+        image.thumbnail(size, Image.LANCZOS)
+
+        output = io.BytesIO()
+        image.save(output, "PNG", optimize=True)
+
+    return output.getvalue()
+
 
 class AvatarWindow(tk.Toplevel):
     def __init__(self, master):
@@ -16,41 +37,77 @@ class AvatarWindow(tk.Toplevel):
         self.transient(master)
 
         self.title("Change Avatar")
-        self.geometry("350x200")
+        self.geometry("350x230")
 
         self.image_file_types = [
+            ("Images", ("*.png", "*.PNG", "*.jpg", "*.JPG", "*.jpeg", "*.JPEG")),
             ("Png Images", ("*.png", "*.PNG")),
+            ("Jpeg Images", ("*.jpg", "*.JPG", "*.jpeg", "*.JPEG")),
         ]
 
         self.current_avatar_image = tk.PhotoImage(file=avatar_file_path)
 
         self.current_avatar = ttk.Label(self, image=self.current_avatar_image)
-        choose_file_button = ttk.Button(self, text="Choose File", command=self.choose_image)
+        self.choose_file_button = ttk.Button(self, text="Choose File", command=self.choose_image)
+        self.progress = ttk.Progressbar(self, orient=tk.HORIZONTAL, length=200, maximum=100)
+        self.status = ttk.Label(self, text="")
 
         self.current_avatar.pack()
-        choose_file_button.pack()
+        self.choose_file_button.pack()
+        self.progress.pack(pady=(5, 0))
+        self.status.pack()
 
     def choose_image(self):
         image_file = filedialog.askopenfilename(filetypes=self.image_file_types)
 
         if image_file:
-            avatar = Image.open(image_file)
-            avatar.thumbnail((128, 128))
-            avatar.save(avatar_file_path, "PNG")
+            self.choose_file_button.configure(state=tk.DISABLED)
+            self.show_progress("Resizing...", 0)
+
+            self.master.executor.submit(
+                self.process_and_upload, image_file,
+                on_success=self.uploaded,
+                on_error=self.upload_failed,
+            )
 
-            img_contents = ""
-            img_b64 = ""
-            with open(avatar_file_path, "rb") as img:
-                img_contents = img.read()
-                img_b64 = base64.urlsafe_b64encode(img_contents)
+    def process_and_upload(self, image_file):
+        """ Runs on a worker thread, so it reports back through the executor rather than touching any widget """
+        image_bytes = prepare_avatar(image_file, upload_size)
 
-            self.master.requester.update_avatar(self.master.username, img_b64)
+        def on_progress(sent, total):
+            self.master.executor.report(self.show_progress, "Uploading...", 100 * sent / total)
+
+        avatar_hash = self.master.requester.update_avatar(self.master.username, image_bytes, on_progress)
+
+        # saved only once the server has it, so a failed upload leaves our copy matching theirs
+        # it is only ever shown at 128, and shrinking the upload is far cheaper than decoding the source again
+        with open(avatar_file_path, "wb") as avatar_file:
+            avatar_file.write(prepare_avatar(io.BytesIO(image_bytes)))
+
+        return avatar_hash
+
+    def show_progress(self, status, percent):
+        if self.winfo_exists():
+            self.status.configure(text=status)
+            self.progress.configure(value=percent)
+
+    def uploaded(self, avatar_hash):
+        if not self.winfo_exists():
+            return
+
+        self.show_progress("Avatar updated", 100)
+        self.choose_file_button.configure(state=tk.NORMAL)
+
+        self.current_avatar_image = tk.PhotoImage(file=avatar_file_path)
+        self.current_avatar.configure(image=self.current_avatar_image)
 
-            self.current_avatar_image = tk.PhotoImage(file=avatar_file_path)
-            self.current_avatar.configure(image=self.current_avatar_image)
+    def upload_failed(self, error):
+        if self.winfo_exists():
+            self.show_progress(f"Could not update avatar: {error}", 0)
+            self.choose_file_button.configure(state=tk.NORMAL)
 
 
 if __name__ == "__main__":
     win = tk.Tk()
     aw = AvatarWindow(win)
-    win.mainloop()
\ No newline at end of file
+    win.mainloop()
@@ -0,0 +1,76 @@
+"""
+Insert latency into a chat Text widget that already holds 1k, 10k and 100k messages,
+unbounded as ChatWindow used to be, and with Scrollback evicting the oldest lines.
+
+    python benchmark_scrollback.py [inserts per size]
+
+Needs a display, as it creates real Tk widgets.
+"""
+import sys
+import time
+
+import tkinter as tk
+
+from scrollback import Scrollback
+
+
+def message(i):
+    return f"friend: message number {i} in a conversation that has gone on for a long time\n"
+
+
+def fill_unbounded(text, count):
+    text.insert(tk.END, "".join(message(i) for i in range(count)))
+
+    def insert(i):
+        text.configure(state='normal')
+        text.insert(tk.END, message(i))
+        text.configure(state='disabled')
+
+    return insert
+
+
+def fill_scrollback(text, count):
+    scrollback = Scrollback(text)
+    for start in range(0, count, 1000):
+        scrollback.append([(i, message(i)) for i in range(start, min(count, start + 1000))])
+        scrollback.trim()
+
+    # ChatWindow trims like this only while the newest message is in view, which mean_insert_ms keeps it
+    def insert(i):
+        scrollback.append([(i, message(i))])
+        scrollback.trim()
+
+    return insert
+
+
+def mean_insert_ms(root, fill, count, inserts):
+    text = tk.Text(root, wrap=tk.WORD, width=30)
+    text.pack()
+    insert = fill(text, count)
+    text.see(tk.END)
+    root.update()
+
+    start = time.perf_counter()
+    for i in range(count, count + inserts):
+        insert(i)
+        text.see(tk.END)
+        root.update()
+    elapsed = time.perf_counter() - start
+
+    lines = int(text.index("end-1c").split(".")[0])
+    text.destroy()
+
+    return elapsed / inserts * 1000, lines
+
+
+if __name__ == '__main__':
+    inserts = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    root = tk.Tk()
+
+    print(f"{'messages':<10}{'unbounded ms':>14}{'lines':>9}{'scrollback ms':>15}{'lines':>9}")
+    for count in (1000, 10000, 100000):
+        unbounded, unbounded_lines = mean_insert_ms(root, fill_unbounded, count, inserts)
+        bounded, bounded_lines = mean_insert_ms(root, fill_scrollback, count, inserts)
+        print(f"{count:<10}{unbounded:>14.3f}{unbounded_lines:>9}{bounded:>15.3f}{bounded_lines:>9}")
+
+    root.destroy()
@@ -0,0 +1,41 @@
+"""
+Packs every smilie into smilies/atlas.png, with each one's (x, y, width, height) in smilies/atlas.json,
+so SmilieRegistry decodes a single image instead of one per smilie. Rerun it after adding a smilie.
+
+    python build_smilie_atlas.py
+"""
+import json
+import os
+
+from PIL import Image
+
+from smilieregistry import SmilieRegistry
+
+
+def build_atlas(smilies_dir=SmilieRegistry.smilies_dir, prefix=SmilieRegistry.prefix):
+    files = sorted(file for file in os.listdir(smilies_dir) if file.startswith(prefix) and file.endswith(".png"))
+    images = [(file[len(prefix):-len(".png")], Image.open(os.path.join(smilies_dir, file)).convert("RGBA")) for file in files]
+
+    # a single row is plenty for a handful of small icons
+    width = sum(image.width for name, image in images)
+    height = max(image.height for name, image in images)
+    atlas = Image.new("RGBA", (width, height), (0, 0, 0, 0))
+
+    index = {}
+    x = 0
+    for name, image in images:
+        atlas.paste(image, (x, 0))
+        index[name] = [x, 0, image.width, image.height]
+        x += image.width
+
+    atlas.save(os.path.join(smilies_dir, "atlas.png"), optimize=True)
+
+    with open(os.path.join(smilies_dir, "atlas.json"), "w") as index_file:
+        json.dump(index, index_file, indent=4, sort_keys=True)
+
+    return index
+
+
+if __name__ == '__main__':
+    index = build_atlas()
+    print(f"Packed {len(index)} smilies into smilies/atlas.png")
@@ -4,7 +4,8 @@ import os
 import tkinter as tk
 import tkinter.ttk as ttk
 
-from listeningthread import ListeningThread
+from scrollback import Scrollback
+from smilieregistry import smilies
 from smilieselect import SmilieSelect
 
 
@@ -17,6 +18,15 @@ class ChatWindow(tk.Toplevel):
         self.minsize(540, 640)
 
         self.friend_username = friend_username
+        self.history_page_size = 50
+        self.oldest_message_id = None
+        self.has_more_history = False
+        self.loading_history = False
+        # milliseconds before the first history page is asked for again after failing
+        self.history_retry_delay = 1000
+        self.last_message_id = 0
+        self.sent_count = 0
+        self.closed = False
 
         self.right_frame = tk.Frame(self)
         self.left_frame = tk.Frame(self)
@@ -24,13 +34,15 @@ class ChatWindow(tk.Toplevel):
 
         self.messages_area = tk.Text(self.left_frame, bg="white", fg="black", wrap=tk.WORD, width=30)
         self.scrollbar = ttk.Scrollbar(self.left_frame, orient='vertical', command=self.messages_area.yview)
-        self.messages_area.configure(yscrollcommand=self.scrollbar.set)
+        self.messages_area.configure(yscrollcommand=self.on_messages_scrolled)
+
+        # older messages are dropped from the top as new ones arrive, and paged back in by scrolling up
+        self.scrollback = Scrollback(self.messages_area, max_lines=2000)
 
         self.text_area = tk.Text(self.bottom_frame, bg="white", fg="black", height=3, width=30)
-        self.text_area.smilies = []
         self.send_button = ttk.Button(self.bottom_frame, text="Send", command=self.send_message, style="send.TButton")
 
-        self.smilies_image = tk.PhotoImage(file="smilies/mikulka-smile-cool.png")
+        self.smilies_image = smilies.get("cool")
         self.smilie_button = ttk.Button(self.bottom_frame, image=self.smilies_image, command=self.smilie_chooser, style="smilie.TButton")
 
         self.profile_picture = tk.PhotoImage(file="images/avatar.png")
@@ -55,10 +67,13 @@ class ChatWindow(tk.Toplevel):
 
         self.configure_styles()
         self.bind_events()
-        self.load_history()
         self.protocol("WM_DELETE_WINDOW", self.close)
-        self.listening_thread = None
-        self.listen()
+        self.load_history()
+
+    def show_friend_avatar(self, avatar_path):
+        if not self.closed:
+            self.friend_profile_picture = tk.PhotoImage(file=avatar_path)
+            self.friend_profile_picture_area.configure(image=self.friend_profile_picture)
 
     def bind_events(self):
         self.bind("<Return>", self.send_message)
@@ -67,80 +82,201 @@ class ChatWindow(tk.Toplevel):
         self.text_area.bind('<Control-s>', self.smilie_chooser)
 
     def load_history(self):
-        history = self.master.requester.prepare_conversation(self.master.username, self.friend_username)
+        if self.closed:
+            return
+
+        self.master.executor.submit(
+            self.master.requester.prepare_conversation, self.master.username, self.friend_username, None, self.history_page_size,
+            on_success=self.history_loaded,
+            on_error=self.history_failed,
+        )
+
+    def history_failed(self, error):
+        if self.closed:
+            return
+
+        # listening needs the id of the newest message to start after, so keep trying for the first page, backing off up to a minute
+        self.after(self.history_retry_delay, self.load_history)
+        self.history_retry_delay = min(self.history_retry_delay * 2, 60000)
+
+    def history_loaded(self, history):
+        if self.closed:
+            return
+
+        self.has_more_history = history['has_more']
+
+        if len(history['history']):
+            self.last_message_id = history['history'][-1]['id']
+            self.oldest_message_id = history['history'][0]['id']
+
+            # anything already here was sent while the history was loading, so it goes after it
+            self.scrollback.prepend(self.history_entries(history['history']))
+
+        self.messages_area.see(tk.END)
+
+        # start listening only now, so nothing arrives twice or ahead of the history
+        self.listen()
+
+    def on_messages_scrolled(self, first, last):
+        self.scrollbar.set(first, last)
+
+        if float(first) == 0.0 and self.has_more_history and not self.loading_history:
+            self.loading_history = True
+            self.after_idle(self.load_older_history)
+
+    def load_older_history(self):
+        # the view may have moved on since this was scheduled, e.g. by the initial scroll to the end
+        if self.messages_area.yview()[0] > 0.0:
+            self.loading_history = False
+            return
+
+        self.master.executor.submit(
+            self.master.requester.prepare_conversation,
+            self.master.username,
+            self.friend_username,
+            self.oldest_message_id,
+            self.history_page_size,
+            on_success=self.older_history_loaded,
+            on_error=self.older_history_failed,
+        )
+
+    def older_history_failed(self, error):
+        # scrolling back to the top again will retry
+        self.loading_history = False
+
+    def older_history_loaded(self, history):
+        if self.closed:
+            return
+
+        self.has_more_history = history['has_more']
 
         if len(history['history']):
-            for message in history['history']:
-                self.receive_message(message['author'], message['message'])
+            self.oldest_message_id = history['history'][0]['id']
+            records = self.scrollback.prepend(self.history_entries(history['history']))
+
+            # keep the line that was at the top of the view in place
+            added_lines = sum(lines for message_id, lines in records)
+            self.messages_area.yview(f"{added_lines + 1}.0")
+
+        self.loading_history = False
 
     def listen(self):
-        self.listening_thread = ListeningThread(self, self.master.username, self.friend_username)
-        self.listening_thread.start()
+        self.master.listening_thread.subscribe(self, self.friend_username, self.last_message_id)
 
     def close(self):
-        if hasattr(self, "listening_thread"):
-            self.listening_thread.running = False
-            self.after(100, self.close)
-        else:
-            self.destroy()
+        self.closed = True
+        self.master.listening_thread.unsubscribe(self.friend_username)
+        if self.master.chat_windows.get(self.friend_username) is self:
+            del self.master.chat_windows[self.friend_username]
+        self.destroy()
 
 
     def send_message(self, event=None):
-        message = self.text_area.get(1.0, tk.END)
+        message = self.get_message()
+
+        if message.strip():
+            # show the message straight away and send it in the background, marking it if that fails
+            self.sent_count += 1
+            sent_tag = f"sent{self.sent_count}"
 
-        if message.strip() or len(self.text_area.smilies):
-            self.master.requester.send_message(
+            # the smilies come back out of their tokens as the message goes into messages_area
+            record = self.scrollback.append([(None, self.format_message(self.master.username, message))], sent_tag)[0]
+
+            self.master.send_executor.submit(
+                self.master.requester.send_message,
                 self.master.username,
                 self.friend_username,
                 message,
+                on_success=lambda message_id: self.mark_sent(sent_tag, record, message_id),
+                on_error=lambda error: self.mark_failed(sent_tag),
             )
 
-            message = "Me: " + message
-            self.messages_area.configure(state='normal')
-            self.messages_area.insert(tk.END, message)
+            self.text_area.delete(1.0, tk.END)
+            self.messages_area.see(tk.END)
+            self.trim_scrollback()
 
-            if len(self.text_area.smilies):
-                last_line_no = self.messages_area.index(tk.END)
-                last_line_no = str(last_line_no).split('.')[0]
-                last_line_no = str(int(last_line_no) - 2)
+        return "break"
 
-                for index, file in self.text_area.smilies:
-                    char_index = str(index).split('.')[1]
-                    char_index = str(int(char_index) + 4)
-                    smilile_index = last_line_no + '.' + char_index
-                    self.messages_area.image_create(smilile_index, image=file)
+    def mark_sent(self, sent_tag, record, message_id):
+        # the id lets an evicted sent message be paged back in like any other
+        record[0] = message_id
 
-            self.text_area.smilies = []
+        if not self.closed:
+            self.messages_area.tag_delete(sent_tag)
 
-            self.messages_area.configure(state='disabled')
+    def mark_failed(self, sent_tag):
+        if self.closed:
+            return
 
-            self.text_area.delete(1.0, tk.END)
+        # the message may already have been trimmed from the top of the scrollback
+        if self.messages_area.tag_ranges(sent_tag):
+            self.messages_area.configure(state='normal')
+            self.messages_area.insert(f"{sent_tag}.first lineend", " (not sent)", "failed")
+            self.messages_area.configure(state='disabled')
 
-        return "break"
+        self.messages_area.tag_delete(sent_tag)
 
     def smilie_chooser(self, event=None):
         SmilieSelect(self)
 
-    def add_smilie(self, smilie):
-        smilie_index = self.text_area.index(self.text_area.image_create(tk.END, image=smilie))
-        self.text_area.smilies.append((smilie_index, smilie))
+    def add_smilie(self, name):
+        # the image's name in the text area says which smilie it is when the message is sent
+        self.text_area.image_create(tk.END, image=smilies.get(name), name=f"smilie_{name}")
+
+    def get_message(self):
+        """ The typed text, with each smilie swapped for its token """
+        parts = []
+
+        for kind, value, index in self.text_area.dump(1.0, tk.END, text=True, image=True):
+            if kind == "text":
+                parts.append(value)
+            elif value.startswith("smilie_"):
+                # repeats of one smilie are named smilie_cool, smilie_cool#1 and so on
+                parts.append(smilies.token(value[len("smilie_"):].split("#")[0]))
+
+        return "".join(parts)
 
     def receive_message(self, author, message):
-        self.messages_area.configure(state='normal')
+        self.receive_messages([{"author": author, "message": message}])
+
+    def receive_messages(self, messages):
+        """ Everything that arrived in one frame goes in with a single insert """
+        # checked before the insert, which pushes the end out of view whenever it runs past the visible area
+        following = self.messages_area.yview()[1] >= 1.0
+
+        self.scrollback.append(self.history_entries(messages))
+
+        # only scroll and trim while the newest message was in view, so nobody reading further up has the text move under them
+        if following:
+            self.messages_area.see(tk.END)
+            self.trim_scrollback()
 
+    def trim_scrollback(self):
+        """ Call with the end of messages_area in view """
+        newest_evicted = self.scrollback.trim()
+        if newest_evicted is not None:
+            self.oldest_message_id = newest_evicted + 1
+            self.has_more_history = True
+
+    def history_entries(self, messages):
+        return [(message['id'], self.format_message(message['author'], message['message'])) for message in messages]
+
+    def format_message(self, author, message):
         if author == self.master.username:
             author = "Me"
 
-        message_with_author = author + ": " + message
+        # scrollback counts lines per message, so each one ends its own line
+        if not message.endswith("\n"):
+            message += "\n"
 
-        self.messages_area.insert(tk.END, message_with_author)
-
-        self.messages_area.configure(state='disabled')
+        return author + ": " + message
 
     def configure_styles(self):
         style = ttk.Style()
         style.configure("send.TButton", background='#dddddd', foreground="black", padding=16)
 
+        self.messages_area.tag_configure("failed", foreground="red")
+
 
 if __name__ == '__main__':
     w = tk.Tk()
@@ -0,0 +1,46 @@
+import tkinter as tk
+import tkinter.ttk as ttk
+
+
+class FriendRow(ttk.Frame):
+    """ One row of the friends list, reused for whichever friend is scrolled into its place """
+
+    def __init__(self, master, friends_list, **kwargs):
+        super().__init__(master, **kwargs)
+        self.friends_list = friends_list
+        self.user = None
+
+        self.profile_photo_label = ttk.Label(self)
+        self.friend_name = ttk.Label(self, anchor=tk.W)
+
+        self.message_button = ttk.Button(self, text="Chat", command=self.message_friend)
+        self.block_button = ttk.Button(self, text="Block", command=self.block_friend)
+
+        self.profile_photo_label.pack(side=tk.LEFT)
+        self.friend_name.pack(side=tk.LEFT)
+        self.message_button.pack(side=tk.RIGHT)
+        self.block_button.pack(side=tk.RIGHT, padx=(0, 30))
+
+    def show(self, user):
+        if user is self.user:
+            return
+
+        self.user = user
+        self.profile_photo = self.friends_list.avatar_cache.get_image(
+            user['avatar_hash'], self.friends_list.friend_avatar_size,
+            on_fetched=lambda image: self.show_avatar(user, image),
+        )
+        self.profile_photo_label.configure(image=self.profile_photo)
+        self.friend_name.configure(text=user['real_name'])
+
+    def show_avatar(self, user, image):
+        # while the avatar was fetched the row may have scrolled onto another friend, or been removed
+        if user is self.user and self.winfo_exists():
+            self.profile_photo = image
+            self.profile_photo_label.configure(image=self.profile_photo)
+
+    def message_friend(self):
+        self.friends_list.open_chat_window(username=self.user["username"], real_name=self.user["real_name"], avatar_hash=self.user["avatar_hash"])
+
+    def block_friend(self):
+        self.friends_list.block_friend(username=self.user["username"])
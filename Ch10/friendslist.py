@@ -1,18 +1,15 @@
-import base64
-import os
 import tkinter as tk
 import tkinter.messagebox as msg
 import tkinter.ttk as ttk
 
-from functools import partial
-
 from chatwindow import ChatWindow
 from requester import Requester
 from avatarwindow import AvatarWindow
 from addfriendwindow import AddFriendWindow
-
-friend_avatars_dir = os.path.abspath(os.path.join(os.path.dirname(__file__), "images/friends"))
-default_avatar_path = os.path.abspath(os.path.join(os.path.dirname(__file__), "images/default.png"))
+from listeningthread import ListeningThread
+from avatarcache import AvatarCache, default_avatar_path
+from friendrow import FriendRow
+from requestexecutor import RequestExecutor
 
 
 class FriendsList(tk.Tk):
@@ -35,6 +32,12 @@ class FriendsList(tk.Tk):
 
         self.requester = Requester()
 
+        # every request runs off the main loop; sends get their own single worker so they arrive in the order typed
+        self.executor = RequestExecutor(self)
+        self.send_executor = RequestExecutor(self, workers=1)
+        self.avatar_cache = AvatarCache(self.requester, self.executor)
+        self.logging_in = False
+
         self.show_login_screen()
 
     def show_login_screen(self):
@@ -47,8 +50,8 @@ class FriendsList(tk.Tk):
         real_name_label = ttk.Label(self.login_frame, text="Real Name")
         self.real_name_entry = ttk.Entry(self.login_frame)
 
-        login_button = ttk.Button(self.login_frame, text="Login", command=self.login)
-        create_account_button = ttk.Button(self.login_frame, text="Create Account", command=self.create_account)
+        self.login_button = ttk.Button(self.login_frame, text="Login", command=self.login)
+        self.create_account_button = ttk.Button(self.login_frame, text="Create Account", command=self.create_account)
 
         username_label.grid(row=0, column=0, sticky='e')
         self.username_entry.grid(row=0, column=1)
@@ -56,8 +59,8 @@ class FriendsList(tk.Tk):
         real_name_label.grid(row=1, column=0, sticky='e')
         self.real_name_entry.grid(row=1, column=1)
 
-        login_button.grid(row=2, column=0, sticky='e')
-        create_account_button.grid(row=2, column=1)
+        self.login_button.grid(row=2, column=0, sticky='e')
+        self.create_account_button.grid(row=2, column=1)
 
         for i in range(3):
             tk.Grid.rowconfigure(self.login_frame, i, weight=1)
@@ -67,119 +70,216 @@ class FriendsList(tk.Tk):
 
         self.login_event = self.bind("<Return>", self.login)
 
+    def set_logging_in(self, logging_in):
+        self.logging_in = logging_in
+
+        state = tk.DISABLED if logging_in else tk.NORMAL
+        self.login_button.configure(state=state)
+        self.create_account_button.configure(state=state)
+
+    def login_failed(self, error):
+        self.set_logging_in(False)
+        msg.showerror("Failed", f"Could not reach the server: {error}")
+
     def login(self, event=None):
+        if self.logging_in:
+            return
+
         username = self.username_entry.get()
         real_name = self.real_name_entry.get()
 
-        if self.requester.login(username, real_name):
+        self.set_logging_in(True)
+        self.executor.submit(
+            self.requester.login, username, real_name,
+            on_success=lambda login: self.logged_in(username, real_name, login),
+            on_error=self.login_failed,
+        )
+
+    def logged_in(self, username, real_name, login):
+        self.set_logging_in(False)
+
+        if login["exists"]:
             self.username = username
             self.real_name = real_name
             self.unbind("<Return>", self.login_event)
-            self.show_friends()
+            self.friends_version = login["version"]
+            self.show_friends(login["friends"])
         else:
             msg.showerror("Failed", f"Could not log in as {username}")
 
     def create_account(self):
+        if self.logging_in:
+            return
+
         username = self.username_entry.get()
         real_name = self.real_name_entry.get()
 
-        if self.requester.create_account(username, real_name):
+        self.set_logging_in(True)
+        self.executor.submit(
+            self.requester.create_account, username, real_name,
+            on_success=lambda created: self.account_created(username, real_name, created),
+            on_error=self.login_failed,
+        )
+
+    def account_created(self, username, real_name, created):
+        self.set_logging_in(False)
+
+        if created:
             self.username = username
             self.real_name = real_name
+            self.unbind("<Return>", self.login_event)
 
-            self.show_friends()
+            # a brand new account has no friends to fetch
+            self.friends_version = 0
+            self.show_friends([])
         else:
             msg.showerror("Failed", "Account already exists!")
 
-    def show_friends(self):
+    def show_friends(self, friends=None):
         self.configure(menu=self.menu)
         self.login_frame.pack_forget()
 
         self.canvas = tk.Canvas(self, bg="white")
-        self.canvas_frame = tk.Frame(self.canvas)
 
         self.scrollbar = ttk.Scrollbar(self, orient="vertical", command=self.canvas.yview)
-        self.canvas.configure(yscrollcommand=self.scrollbar.set)
+        self.canvas.configure(yscrollcommand=self.on_friends_scrolled)
 
         self.scrollbar.pack(side=tk.LEFT, fill=tk.Y)
         self.canvas.pack(side=tk.LEFT, expand=1, fill=tk.BOTH)
 
-        self.friends_area = self.canvas.create_window((0, 0), window=self.canvas_frame, anchor="nw")
+        # only the rows on screen exist as widgets; they are moved and refilled as the list scrolls
+        self.friends = []
+        self.friend_rows = []
+        # rows ask the server for small avatars, which saves bandwidth and PhotoImage memory over the full size
+        self.friend_avatar_size = 64
+        self.friend_row_height = 72
+        self.friends_scrollregion = None
 
         self.bind_events()
 
-        self.load_friends()
+        self.chat_windows = {}
+        self.listening_thread = ListeningThread(self, self.username)
+        self.listening_thread.start()
+
+        self.load_friends(friends)
 
     def bind_events(self):
-        self.bind('<Configure>', self.on_frame_resized)
         self.canvas.bind('<Configure>', self.friends_width)
 
     def friends_width(self, event):
         canvas_width = event.width
-        self.canvas.itemconfig(self.friends_area, width=canvas_width)
+        for row in self.friend_rows:
+            self.canvas.itemconfig(row.window, width=canvas_width)
+
+        self.render_friends()
+
+    def on_friends_scrolled(self, first, last):
+        self.scrollbar.set(first, last)
+        self.render_friends()
+
+    def render_friends(self):
+        canvas_width = self.canvas.winfo_width()
+        canvas_height = self.canvas.winfo_height()
+
+        # only touch the scrollregion when it changes, as doing so calls back into on_friends_scrolled
+        scrollregion = (0, 0, canvas_width, len(self.friends) * self.friend_row_height)
+        if scrollregion != self.friends_scrollregion:
+            self.friends_scrollregion = scrollregion
+            self.canvas.configure(scrollregion=scrollregion)
 
-    def on_frame_resized(self, event=None):
-        self.canvas.configure(scrollregion=self.canvas.bbox("all"))
+        first = max(0, int(self.canvas.canvasy(0) // self.friend_row_height))
+        last = min(len(self.friends), first + canvas_height // self.friend_row_height + 2)
+        visible = max(0, last - first)
 
-    def load_friends(self):
-        my_friends = self.requester.get_friends(self.username)
-        for user in my_friends["friends"]:
-            if user['username'] != self.username:
-                friend_frame = ttk.Frame(self.canvas_frame)
+        while len(self.friend_rows) < visible:
+            row = FriendRow(self.canvas, self)
+            row.window = self.canvas.create_window(0, 0, window=row, anchor="nw", width=canvas_width, height=self.friend_row_height)
+            self.friend_rows.append(row)
 
-                friend_avatar_path = os.path.join(friend_avatars_dir, f"{user['username']}.png")
+        while len(self.friend_rows) > visible:
+            row = self.friend_rows.pop()
+            self.canvas.delete(row.window)
+            row.destroy()
 
-                if user["avatar"]:
-                    with open(friend_avatar_path, 'wb') as friend_avatar:
-                        img = base64.urlsafe_b64decode(user['avatar'])
-                        friend_avatar.write(img)
-                else:
-                    friend_avatar_path = default_avatar_path
+        for offset, row in enumerate(self.friend_rows):
+            index = first + offset
+            row.show(self.friends[index])
+            self.canvas.coords(row.window, 0, index * self.friend_row_height)
 
-                profile_photo = tk.PhotoImage(file=friend_avatar_path)
-                profile_photo_label = ttk.Label(friend_frame, image=profile_photo)
-                profile_photo_label.image = profile_photo
+    def load_friends(self, friends=None):
+        if friends is None:
+            self.executor.submit(self.requester.get_friends, self.username, on_success=self.friends_loaded)
+            return
 
-                friend_name = ttk.Label(friend_frame, text=user['real_name'], anchor=tk.W)
+        self.friends = [user for user in friends if user['username'] != self.username]
+        self.render_friends()
 
-                message_this_friend = partial(self.open_chat_window, username=user["username"], real_name=user["real_name"], avatar=friend_avatar_path)
-                block_this_friend = partial(self.block_friend, username=user["username"])
+    def friends_loaded(self, friends_list):
+        self.friends_version = friends_list["version"]
+        self.load_friends(friends_list["friends"])
 
-                message_button = ttk.Button(friend_frame, text="Chat", command=message_this_friend)
-                block_button = ttk.Button(friend_frame, text="Block", command=block_this_friend)
+    def refresh_friends(self):
+        """ Apply only the rows that changed since our version, leaving every other row alone """
+        self.executor.submit(self.requester.get_friends, self.username, self.friends_version, on_success=self.apply_friends_delta)
 
-                profile_photo_label.pack(side=tk.LEFT)
-                friend_name.pack(side=tk.LEFT)
-                message_button.pack(side=tk.RIGHT)
-                block_button.pack(side=tk.RIGHT, padx=(0, 30))
+    def apply_friends_delta(self, delta):
+        # a full reload or an earlier delta may have got here first
+        if delta["version"] <= self.friends_version:
+            return
 
-                friend_frame.pack(fill=tk.X, expand=1)
+        self.friends_version = delta["version"]
 
-    def reload_friends(self):
-        for child in self.canvas_frame.winfo_children():
-            child.pack_forget()
-        self.load_friends()
+        removed = set(delta["removed"])
+        changed = {user["username"]: user for user in delta["changed"]}
+
+        friends = []
+        for user in self.friends:
+            if user["username"] in removed:
+                continue
+            friends.append(changed.pop(user["username"], user))
+
+        friends.extend(changed.values())
+        self.friends = friends
+
+        self.render_friends()
 
     def show_add_friend_window(self):
         AddFriendWindow(self)
 
-    def add_friend(self, username):
-        if self.requester.add_friend(self.username, username):
+    def add_friend(self, username, on_added=None):
+        self.executor.submit(
+            self.requester.add_friend, self.username, username,
+            on_success=lambda success: self.friend_added(success, on_added),
+        )
+
+    def friend_added(self, success, on_added=None):
+        if success:
             msg.showinfo("Friend Added", "Friend Added")
-            success = True
-            self.reload_friends()
+            self.refresh_friends()
+            if on_added:
+                on_added()
         else:
             msg.showerror("Add Failed", "Friend was not found")
-            success = False
 
-        return success
+    def open_chat_window(self, username, real_name, avatar_hash):
+        # one window per friend, as the listening thread delivers each friend's messages to a single window
+        chat_window = self.chat_windows.get(username)
+        if chat_window is not None and not chat_window.closed:
+            chat_window.deiconify()
+            chat_window.lift()
+            chat_window.focus_force()
+            return
+
+        # the chat window shows the full 128 pixel avatar, swapped in if it has to be fetched first
+        chat_window = ChatWindow(self, real_name, username, default_avatar_path)
+        avatar_path = self.avatar_cache.get_path(avatar_hash, 128, on_fetched=chat_window.show_friend_avatar)
+        if avatar_path != default_avatar_path:
+            chat_window.show_friend_avatar(avatar_path)
 
-    def open_chat_window(self, username, real_name, avatar):
-        cw = ChatWindow(self, real_name, username, avatar)
+        self.chat_windows[username] = chat_window
 
     def block_friend(self, username):
-        self.requester.block_friend(self.username, username)
-        self.reload_friends()
+        self.executor.submit(self.requester.block_friend, self.username, username, on_success=lambda blocked: self.refresh_friends())
 
     def change_avatar(self):
         AvatarWindow(self)
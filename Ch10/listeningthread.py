@@ -1,29 +1,89 @@
-import arrow
 import threading
 import time
 
-from requester import Requester
+from collections import deque
 
 
 class ListeningThread(threading.Thread):
-    def __init__(self, master, user_one, user_two):
-        super().__init__()
+    """ A single listener that long-polls for every open ChatWindow at once """
+
+    def __init__(self, master, username, retry_interval=3, frame_interval=16):
+        """ frame_interval is how often, in milliseconds, the main loop takes delivered messages """
+        super().__init__(daemon=True)
         self.master = master
-        self.user_one = user_one
-        self.user_two = user_two
-        self.requester = Requester()
+        self.username = username
+        self.requester = master.requester
         self.running = True
-        self.last_checked_time = arrow.now().timestamp
+        self.retry_interval = retry_interval
+
+        self.lock = threading.Lock()
+        self.subscriptions = {}
+        self.subscriptions_changed = threading.Event()
+
+        # appending and popping at opposite ends of a deque is atomic, so this thread and the main loop need no lock
+        self.deliveries = deque()
+        self.frame_interval = frame_interval
+
+    def subscribe(self, chat_window, friend_username, last_message_id=0):
+        with self.lock:
+            self.subscriptions[friend_username] = {"window": chat_window, "last_id": last_message_id}
+        self.subscriptions_changed.set()
+
+    def unsubscribe(self, friend_username):
+        with self.lock:
+            self.subscriptions.pop(friend_username, None)
+        self.subscriptions_changed.set()
+
+    def stop(self):
+        self.running = False
+        self.subscriptions_changed.set()
+
+    def start(self):
+        super().start()
+        self.master.after(self.frame_interval, self.deliver)
+
+    def deliver(self):
+        """ Runs on the main loop: hands each window everything that arrived for it since the last frame """
+        messages_by_window = {}
+        while True:
+            try:
+                window, messages = self.deliveries.popleft()
+            except IndexError:
+                break
+            messages_by_window.setdefault(window, []).extend(messages)
+
+        for window, messages in messages_by_window.items():
+            if not window.closed:
+                window.receive_messages(messages)
+
+        if self.running:
+            self.master.after(self.frame_interval, self.deliver)
 
     def run(self):
         while self.running:
-            new_messages = self.requester.get_new_messages(self.last_checked_time, self.user_one, self.user_two)
-            self.last_checked_time = arrow.now().timestamp
-            for message in new_messages['messages']:
-                self.master.receive_message(message["author"], message["message"])
+            with self.lock:
+                conversations = {friend: sub["last_id"] for friend, sub in self.subscriptions.items()}
+                self.subscriptions_changed.clear()
+
+            if not conversations:
+                self.subscriptions_changed.wait()
+                continue
+
+            try:
+                received = self.requester.wait_for_messages_batch(self.username, conversations)["conversations"]
+            except Exception:
+                # a dropped connection, an error page or a body we cannot decode; this thread serves every window, so it must not die
+                time.sleep(self.retry_interval)
+                continue
 
-            time.sleep(3)
+            for friend, conversation in received.items():
+                with self.lock:
+                    subscription = self.subscriptions.get(friend)
+                    if subscription is None:
+                        continue
+                    subscription["last_id"] = max(subscription["last_id"], conversation["last_id"])
 
-        del self.master.listening_thread
+                if conversation["messages"]:
+                    self.deliveries.append((subscription["window"], conversation["messages"]))
 
         return
@@ -1,63 +1,173 @@
 import json
+import threading
+import time
+
 import requests
 
+from requests.adapters import HTTPAdapter
 
-class Requester:
-    def __init__(self):
-        self.url = "http://127.0.0.1:5000"
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
 
-    def request(self, method, endpoint, params=None):
-        url = self.url + endpoint
 
-        if method == "GET":
-            r = requests.get(url, params=params)
+class ProgressReader:
+    """ Bytes that requests streams as a request body, calling on_progress(sent, total) as each block goes out """
+
+    def __init__(self, data, on_progress=None):
+        self.data = data
+        self.on_progress = on_progress
+        self.position = 0
+
+    def __len__(self):
+        # lets requests send a Content-Length rather than a chunked body
+        return len(self.data)
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            size = len(self.data) - self.position
 
-            return r.text
+        block = self.data[self.position:self.position + size]
+        self.position += len(block)
+
+        if self.on_progress:
+            self.on_progress(self.position, len(self.data))
+
+        return block
+
+
+class Requester:
+    def __init__(self, url="http://127.0.0.1:5000", pool_size=10, timeout=(3.05, 30)):
+        """ timeout is (connect, read) seconds, used for any request that does not give its own """
+        self.url = url
+        self.timeout = timeout
+
+        # one keep-alive session for the UI thread and the listening thread; its connection pool is thread safe
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+        # requests already asks for gzip and deflate and decompresses them; MessagePack is only asked for if we can read it
+        if msgpack is not None:
+            self.session.headers["Accept"] = "application/msgpack, application/json;q=0.9"
         else:
-            r = requests.post(url, data=params)
+            self.session.headers["Accept"] = "application/json"
+
+        self.stats_lock = threading.Lock()
+        self.latency_stats = {}
 
-            return r.json()
+    def request(self, method, endpoint, params=None, timeout=None, as_json=False, headers=None, raw=False):
+        url = self.url + endpoint
+        timeout = timeout or self.timeout
+        start = time.perf_counter()
+
+        try:
+            if method == "GET":
+                r = self.session.get(url, params=params, timeout=timeout, headers=headers)
+
+                if r.status_code == 304:
+                    return None
+            elif as_json:
+                r = self.session.post(url, json=params, timeout=timeout, headers=headers)
+            else:
+                r = self.session.post(url, data=params, timeout=timeout, headers=headers)
+
+            # an error page is not a result, whatever format it comes in
+            r.raise_for_status()
+
+            if raw:
+                return r.content
+
+            return self.decode(r)
+        finally:
+            self.record_latency(endpoint, time.perf_counter() - start)
+
+    def decode(self, response):
+        if response.headers.get("Content-Type", "").startswith("application/msgpack"):
+            return msgpack.unpackb(response.content, raw=False)
+
+        return response.json()
+
+    def record_latency(self, endpoint, seconds):
+        # group /get_friends/<username> and friends under one name
+        name = "/" + endpoint.split("/")[1]
+
+        with self.stats_lock:
+            stats = self.latency_stats.setdefault(name, {"count": 0, "total": 0.0, "max": 0.0})
+            stats["count"] += 1
+            stats["total"] += seconds
+            stats["max"] = max(stats["max"], seconds)
+
+    def get_latency_stats(self):
+        with self.stats_lock:
+            return {
+                name: {
+                    "count": stats["count"],
+                    "mean_ms": stats["total"] / stats["count"] * 1000,
+                    "max_ms": stats["max"] * 1000,
+                }
+                for name, stats in self.latency_stats.items()
+            }
+
+    def close(self):
+        self.session.close()
 
     def login(self, username, real_name):
-        endpoint = "/user_exists"
+        """ Returns {"exists": bool, "friends": [...]} so the friends list needs no second request """
+        endpoint = "/login"
         params = {"username": username, "real_name": real_name}
 
-        user_exists = self.request("POST", endpoint, params)
-
-        if user_exists["exists"]:
-            return True
-
-        return False
+        return self.request("POST", endpoint, params)
 
     def create_account(self, username, real_name):
-        endpoint = "/user_exists"
-        params = {"username": username}
-        exists = self.request("POST", endpoint, params)
+        endpoint = "/create_account"
+        params = {"username": username, "real_name": real_name}
 
-        if exists["exists"]:
-            return False
+        created = self.request("POST", endpoint, params)
 
-        endpoint = "/add_user"
-        params = {"username": username, "real_name": real_name}
+        return created["created"]
 
-        self.request("POST", endpoint, params)
+    def batch(self, operations):
+        """ operations is a list of (name, params) pairs run by the server in one transaction """
+        endpoint = "/batch"
+        params = {
+            "operations": [{"op": name, "params": op_params} for name, op_params in operations]
+        }
 
-        return True
+        results = self.request("POST", endpoint, params, as_json=True)
 
-    def get_all_users(self):
-        endpoint = "/get_all_users"
+        return results["results"]
 
-        users = self.request("GET", endpoint)
+    def get_all_users(self, query="", after=None, limit=100):
+        """ Yields each user as its line arrives, then {"next": cursor} for the following page """
+        endpoint = "/get_all_users"
+        params = {"q": query, "limit": limit}
 
-        return json.loads(users)
+        if after:
+            params["after"] = after
 
-    def prepare_conversation(self, user_one, user_two):
-        endpoint = "/create_conversation_db"
-        params = {"user_one": user_one, "user_two": user_two}
+        start = time.perf_counter()
 
-        self.request("POST", endpoint, params)
+        try:
+            with self.session.get(self.url + endpoint, params=params, timeout=self.timeout, stream=True) as r:
+                r.raise_for_status()
+                for line in r.iter_lines():
+                    if line:
+                        yield json.loads(line)
+        finally:
+            self.record_latency(endpoint, time.perf_counter() - start)
 
+    def prepare_conversation(self, user_one, user_two, before_id=None, limit=50):
+        """ Fetches the newest limit messages, or the page before before_id when scrolling back """
+        # the shared messages table needs no per-conversation setup, so this is a single request
         endpoint = "/get_message_history"
+        params = {"user_one": user_one, "user_two": user_two, "limit": limit}
+
+        if before_id is not None:
+            params["before_id"] = before_id
+
         history = self.request("POST", endpoint, params)
 
         return history
@@ -69,32 +179,31 @@ class Requester:
             "message": message,
         }
 
-        self.request("POST", endpoint, params)
-
-        return True
+        sent = self.request("POST", endpoint, params)
 
-    def get_user_avatar(self, username):
-        endpoint = f"/get_user_avatar/{username}"
+        return sent["id"]
 
-        avatar = self.request("GET", endpoint)
+    def get_avatar_image(self, avatar_hash, size=None):
+        """ size is 32, 64 or 128 for a copy the server has shrunk to fit, or None for the original """
+        endpoint = f"/avatar/{avatar_hash}"
+        params = {"size": size} if size else None
 
-        return json.loads(avatar)
+        return self.request("GET", endpoint, params, raw=True)
 
-    def update_avatar(self, username, img_b64):
+    def update_avatar(self, username, image_bytes, on_progress=None):
+        """ Streams the PNG as the raw request body and returns its new avatar hash """
         endpoint = f"/update_avatar/{username}"
-        params = {
-            "img_b64": img_b64
-        }
+        headers = {"Content-Type": "image/png"}
 
-        self.request("POST", endpoint, params)
+        result = self.request("POST", endpoint, ProgressReader(image_bytes, on_progress), headers=headers)
 
-        return True
+        return result["avatar_hash"]
 
-    def get_new_messages(self, timestamp, user_one, user_two):
+    def get_new_messages(self, after_id, user_one, user_two):
         """ user_one is the author's username, and user_two is the friend's """
         endpoint = "/get_new_messages"
         params = {
-            "timestamp": timestamp,
+            "after_id": after_id,
             "user_one": user_one,
             "user_two": user_two,
         }
@@ -103,6 +212,33 @@ class Requester:
 
         return new_messages
 
+    def wait_for_messages(self, after_id, user_one, user_two, timeout=25):
+        """ Like get_new_messages, but the server holds the request open until a message arrives or timeout passes """
+        endpoint = "/wait_for_messages"
+        params = {
+            "after_id": after_id,
+            "user_one": user_one,
+            "user_two": user_two,
+            "timeout": timeout,
+        }
+
+        new_messages = self.request("POST", endpoint, params, timeout=timeout + 10)
+
+        return new_messages
+
+    def wait_for_messages_batch(self, username, conversations, timeout=25):
+        """ conversations maps each open friend's username to the last message id we have from them """
+        endpoint = "/wait_for_messages_batch"
+        params = {
+            "username": username,
+            "conversations": conversations,
+            "timeout": timeout,
+        }
+
+        new_messages = self.request("POST", endpoint, params, timeout=timeout + 10, as_json=True)
+
+        return new_messages
+
     def add_friend(self, user_one, user_two):
         endpoint = "/add_friend"
         params = {
@@ -114,12 +250,14 @@ class Requester:
 
         return success["success"]
 
-    def get_friends(self, username):
+    def get_friends(self, username, since_version=None):
+        """ Without since_version this is the whole list, otherwise only what changed after that version """
         endpoint = f"/get_friends/{username}"
+        params = {"since": since_version} if since_version is not None else None
 
-        friends = self.request("GET", endpoint)
+        friends = self.request("GET", endpoint, params)
 
-        return json.loads(friends)
+        return friends
 
     def block_friend(self, user_one, user_two):
         endpoint = "/block_friend"
@@ -0,0 +1,65 @@
+import queue
+import tkinter.messagebox as msg
+
+from concurrent.futures import ThreadPoolExecutor
+
+
+class RequestExecutor:
+    """ Runs blocking requester calls on worker threads and calls back with their results on the Tk main loop """
+
+    def __init__(self, master, workers=4, poll_interval=16):
+        """ poll_interval is in milliseconds; 16 checks for finished requests about once a frame at 60 fps """
+        self.master = master
+        self.poll_interval = poll_interval
+
+        self.pool = ThreadPoolExecutor(max_workers=workers)
+        # (callback, args) to run on the main loop, in the order worker threads queued them
+        self.calls = queue.Queue()
+        self.pending = 0
+        self.polling = False
+
+    def submit(self, function, *args, on_success=None, on_error=None):
+        """ Call from the main thread. on_success gets function's return value, on_error the exception it raised """
+        future = self.pool.submit(function, *args)
+        # worker threads must not touch Tk, so they only put the finished future on a queue
+        future.add_done_callback(lambda future: self.calls.put((self.finish, (future, on_success, on_error))))
+
+        self.pending += 1
+        if not self.polling:
+            self.polling = True
+            self.master.after(self.poll_interval, self.poll)
+
+        return future
+
+    def report(self, callback, *args):
+        """ Call from inside a submitted function, e.g. for progress, to have callback(*args) run on the main loop """
+        self.calls.put((callback, args))
+
+    def poll(self):
+        while True:
+            try:
+                callback, args = self.calls.get_nowait()
+            except queue.Empty:
+                break
+
+            callback(*args)
+
+        if self.pending:
+            self.master.after(self.poll_interval, self.poll)
+        else:
+            self.polling = False
+
+    def finish(self, future, on_success, on_error):
+        self.pending -= 1
+        error = future.exception()
+
+        if error is None:
+            if on_success:
+                on_success(future.result())
+        elif on_error:
+            on_error(error)
+        else:
+            msg.showerror("Connection Problem", f"Could not reach the server: {error}")
+
+    def shutdown(self):
+        self.pool.shutdown(wait=False)
@@ -0,0 +1,64 @@
+import tkinter as tk
+
+from collections import deque
+
+from smilieregistry import smilies
+
+
+class Scrollback:
+    """ Holds a read-only Text widget to about max_lines lines, evicting whole messages from the top """
+
+    def __init__(self, text, max_lines=2000):
+        self.text = text
+        self.max_lines = max_lines
+
+        # [message id, line count] for each message shown, oldest first; sent messages have no id until the server replies
+        self.messages = deque()
+        self.lines = 0
+
+    def insert(self, index, entries, tags=()):
+        """ entries is a list of (message id, text) pairs, which go in with a single insert plus one per smilie """
+        records = [[message_id, text.count("\n")] for message_id, text in entries]
+        plain_text, images = smilies.expand("".join(text for message_id, text in entries))
+
+        self.text.configure(state='normal')
+        start = self.text.index("end-1c" if index == tk.END else index)
+        self.text.insert(index, plain_text, tags)
+        for offset, image in images:
+            self.text.image_create(f"{start} + {offset} chars", image=image)
+        self.text.configure(state='disabled')
+
+        self.lines += sum(lines for message_id, lines in records)
+
+        return records
+
+    def append(self, entries, tags=()):
+        records = self.insert(tk.END, entries, tags)
+        self.messages.extend(records)
+
+        return records
+
+    def prepend(self, entries, tags=()):
+        records = self.insert("1.0", entries, tags)
+        self.messages.extendleft(reversed(records))
+
+        return records
+
+    def trim(self):
+        """ Evicts the oldest messages beyond max_lines, returning the newest evicted id or None if none were """
+        evicted_lines = 0
+        newest_evicted = None
+
+        while self.lines - evicted_lines > self.max_lines and len(self.messages) > 1:
+            message_id, lines = self.messages.popleft()
+            evicted_lines += lines
+            if message_id is not None:
+                newest_evicted = message_id
+
+        if evicted_lines:
+            self.text.configure(state='normal')
+            self.text.delete("1.0", f"{evicted_lines + 1}.0")
+            self.text.configure(state='disabled')
+            self.lines -= evicted_lines
+
+        return newest_evicted
@@ -0,0 +1,25 @@
+import asyncio
+import functools
+
+from concurrent.futures import ThreadPoolExecutor
+
+
+class AsyncDatabase:
+    """ Runs the blocking Database methods on a thread pool sized to its connection pool """
+
+    def __init__(self, database):
+        self.database = database
+        self.executor = ThreadPoolExecutor(max_workers=database.pool_size or 1)
+
+    async def run(self, function, *args):
+        loop = asyncio.get_event_loop()
+
+        return await loop.run_in_executor(self.executor, functools.partial(function, *args))
+
+    def __getattr__(self, name):
+        method = getattr(self.database, name)
+
+        async def run_method(*args):
+            return await self.run(method, *args)
+
+        return run_method
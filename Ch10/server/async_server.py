@@ -0,0 +1,414 @@
+import asyncio
+import base64
+import os
+import time
+import arrow
+
+from functools import partial
+
+from aiohttp import web
+
+from async_database import AsyncDatabase
+from avatarstore import AvatarStore
+from database import Database
+from message_writer import MessageWriter
+from conversation import Conversation, collect_new_messages, get_conversation_id_for_users
+from notifier import AsyncMessageNotifier
+from response_cache import ResponseCache
+import operations
+import wire_format
+
+
+routes = web.RouteTableDef()
+
+database = AsyncDatabase(Database(pool_size=int(os.environ.get("CHAT_DB_POOL_SIZE", 5))))
+# messages get their own single connection that fsyncs each commit, shared by a whole batch
+message_writer = MessageWriter(
+    Database(pool_size=1, synchronous="FULL"),
+    flush_interval=float(os.environ.get("CHAT_FLUSH_INTERVAL", 0)),
+    max_batch=int(os.environ.get("CHAT_MAX_BATCH", 256)),
+)
+notifier = AsyncMessageNotifier()
+avatar_store = AvatarStore()
+response_cache = ResponseCache(
+    max_entries=int(os.environ.get("CHAT_CACHE_SIZE", 1024)),
+    ttl=float(os.environ.get("CHAT_CACHE_TTL", 60)),
+)
+
+MAX_WAIT_SECONDS = 60
+MAX_USERS_PAGE = 1000
+
+
+@routes.get("/")
+async def index(request):
+    data = {
+        "cats": 5,
+        "people": 8,
+        "dogs": 4
+    }
+
+    return respond(request, data)
+
+
+@routes.post("/send_me_data")
+async def send_me_data(request):
+    data = await request.post()
+    for key, value in data.items():
+        print("received", key, "with value", value)
+
+    return web.Response(text="Thanks")
+
+
+@routes.get("/get_all_users")
+async def get_all_users(request):
+    prefix = request.query.get("q", "")
+    after = request.query.get("after", "")
+    limit = min(int(request.query.get("limit", 100)), MAX_USERS_PAGE)
+
+    search = partial(database.database.search_users, prefix, after, limit + 1)
+    users = await database.run(response_cache.get_or_compute, ("all_users", prefix, after, limit), search)
+
+    response = web.StreamResponse(headers={"Content-Type": "application/x-ndjson"})
+    await response.prepare(request)
+    for line in operations.users_as_ndjson(users, limit):
+        await response.write(line.encode())
+    await response.write_eof()
+
+    return response
+
+
+@routes.post("/add_user")
+async def add_user(request):
+    data = await request.post()
+    username = data["username"]
+    real_name = data["real_name"]
+
+    await database.add_user(username, real_name)
+    response_cache.invalidate_prefix(("all_users",))
+
+    return respond(
+        request, "User Created"
+    )
+
+
+@routes.post("/user_exists")
+async def user_exists(request):
+    data = await request.post()
+    username = data.get("username")
+    exists = await database.user_exists(username)
+
+    return respond(request, {
+        "exists": exists
+    })
+
+
+@routes.post("/login")
+async def login(request):
+    data = await request.post()
+    result = await database.run(operations.login, database.database, data.get("username"))
+
+    return respond(request, result)
+
+
+@routes.post("/create_account")
+async def create_account(request):
+    data = await request.post()
+    created = await database.run(operations.create_account, database.database, data["username"], data["real_name"])
+    if created:
+        response_cache.invalidate_prefix(("all_users",))
+
+    return respond(request, {
+        "created": created
+    })
+
+
+@routes.post("/batch")
+async def batch(request):
+    try:
+        data = await request.json()
+        results = await database.run(operations.run_batch, database.database, data["operations"])
+    except (KeyError, TypeError, ValueError) as e:
+        return respond(request, {"error": str(e)}, status=400)
+
+    if operations.batch_writes(data["operations"]):
+        response_cache.clear()
+
+    return respond(request, {
+        "results": results
+    })
+
+
+@routes.post("/create_conversation_db")
+async def create_conversation_db(request):
+    return respond(request, {
+        "success": True,
+    })
+
+
+@routes.post("/get_message_history")
+async def get_message_history(request):
+    data = await request.post()
+    history = await database.run(operations.get_message_history, database.database, data)
+
+    return respond(request, history)
+
+
+@routes.post("/send_message/{username}")
+async def send_message(request):
+    username = request.match_info["username"]
+    data = await request.post()
+    author = data["author"]
+    message = data["message"]
+    date_sent = arrow.now().timestamp
+
+    conversation_id = get_conversation_id_for_users({"user_one": author, "user_two": username})
+    if message_writer.is_idle():
+        # a lone message is committed straight away on a database thread, which write does once it sees nothing queued
+        message_id = await database.run(message_writer.write, conversation_id, author, message, date_sent)
+    else:
+        # resolves only once the batch holding this message is committed
+        message_id = await asyncio.wrap_future(message_writer.submit(conversation_id, author, message, date_sent))
+    notifier.notify(username)
+
+    return respond(request, {
+        "success": True,
+        "id": message_id,
+    })
+
+
+@routes.post("/update_avatar/{username}")
+async def update_avatar(request):
+    username = request.match_info["username"]
+
+    try:
+        if request.content_type == "image/png":
+            image_bytes = await request.read()
+        else:
+            data = await request.post()
+            if "avatar" in data:
+                image_bytes = data["avatar"].file.read()
+            else:
+                image_bytes = base64.urlsafe_b64decode(data["img_b64"])
+
+        avatar_hash = await database.run(avatar_store.save, image_bytes)
+    except (KeyError, ValueError) as e:
+        return respond(request, {"error": str(e)}, status=400)
+
+    await database.update_avatar(username, avatar_hash)
+    await invalidate_user(username)
+
+    return respond(request, {
+        "success": True,
+        "avatar_hash": avatar_hash,
+    })
+
+
+@routes.get("/get_user_avatar/{username}")
+async def get_avatar(request):
+    username = request.match_info["username"]
+    results = await database.run(response_cache.get_or_compute, ("avatar", username), partial(database.database.get_user_avatar, username))
+    avatar = results[0] if results else {"avatar_hash": None}
+
+    if not avatar["avatar_hash"]:
+        return respond(request, avatar)
+
+    etag = f'"{avatar["avatar_hash"]}"'
+    if request.headers.get("If-None-Match") == etag:
+        return web.Response(status=304, headers={"ETag": etag})
+
+    return respond(request, avatar, headers={"ETag": etag})
+
+
+@routes.get("/avatar/{avatar_hash}")
+async def get_avatar_image(request):
+    avatar_hash = request.match_info["avatar_hash"]
+    size = request.query.get("size")
+
+    if not avatar_store.is_valid_hash(avatar_hash):
+        raise web.HTTPNotFound()
+
+    if size is None:
+        path = avatar_store.path(avatar_hash)
+        etag = avatar_hash
+    else:
+        if not size.isdigit() or int(size) not in avatar_store.sizes:
+            raise web.HTTPNotFound()
+
+        try:
+            # resizing is CPU work, so it happens off the event loop the first time each size is asked for
+            path = await database.run(avatar_store.sized_path, avatar_hash, int(size))
+        except OSError:
+            # missing, or an original saved before uploads were checked that cannot be resized
+            raise web.HTTPNotFound()
+        etag = f"{avatar_hash}-{size}"
+
+    if not os.path.exists(path):
+        raise web.HTTPNotFound()
+
+    # FileResponse handles Range and If-Modified-Since itself
+    return web.FileResponse(path, headers={
+        "Content-Type": "image/png",
+        "Cache-Control": "public, max-age=31536000",
+        "ETag": f'"{etag}"',
+    })
+
+
+@routes.post("/get_new_messages")
+async def get_new_messages(request):
+    data = await request.post()
+    conversation = Conversation(database.database, get_conversation_id_for_users(data))
+
+    requester_username = data["user_one"]
+
+    if "after_id" in data:
+        after_id = int(data["after_id"])
+        messages = await database.run(conversation.get_messages_after, after_id)
+        last_id = messages[-1]["id"] if messages else after_id
+        new_messages = [message for message in messages if message["author"] != requester_username]
+    else:
+        new_messages = await database.run(conversation.get_new_messages, data["timestamp"], requester_username)
+        last_id = new_messages[-1]["id"] if new_messages else None
+
+    return respond(request, {
+        "messages": new_messages,
+        "last_id": last_id,
+    })
+
+
+@routes.post("/wait_for_messages")
+async def wait_for_messages(request):
+    data = await request.post()
+    conversation = Conversation(database.database, get_conversation_id_for_users(data))
+
+    requester_username = data["user_one"]
+    last_id = int(data["after_id"])
+    timeout = min(float(data.get("timeout", 25)), MAX_WAIT_SECONDS)
+    deadline = time.monotonic() + timeout
+
+    while True:
+        version = notifier.version(requester_username)
+        messages = await database.run(conversation.get_messages_after, last_id)
+        if messages:
+            last_id = messages[-1]["id"]
+
+        new_messages = [message for message in messages if message["author"] != requester_username]
+        remaining = deadline - time.monotonic()
+
+        if new_messages or remaining <= 0:
+            break
+
+        await notifier.wait(requester_username, version, remaining)
+
+    return respond(request, {
+        "messages": new_messages,
+        "last_id": last_id,
+    })
+
+
+@routes.post("/wait_for_messages_batch")
+async def wait_for_messages_batch(request):
+    data = await request.json()
+    requester_username = data["username"]
+    timeout = min(float(data.get("timeout", 25)), MAX_WAIT_SECONDS)
+
+    friends_by_conversation = {}
+    cursors = {}
+    for friend, after_id in data["conversations"].items():
+        conversation_id = get_conversation_id_for_users({"user_one": requester_username, "user_two": friend})
+        friends_by_conversation[conversation_id] = friend
+        cursors[conversation_id] = int(after_id)
+
+    version = notifier.version(requester_username)
+    new_messages = await database.run(collect_new_messages, database.database, requester_username, cursors)
+
+    if not any(new_messages.values()):
+        await notifier.wait(requester_username, version, timeout)
+        new_messages = await database.run(collect_new_messages, database.database, requester_username, cursors)
+
+    conversations = {}
+    for conversation_id, friend in friends_by_conversation.items():
+        conversations[friend] = {
+            "messages": new_messages[conversation_id],
+            "last_id": cursors[conversation_id],
+        }
+
+    return respond(request, {
+        "conversations": conversations
+    })
+
+
+@routes.post("/add_friend")
+async def add_friend(request):
+    data = await request.post()
+    user_one = data['user_one']
+    user_two = data['user_two']
+
+    success = await database.run(operations.add_friend, database.database, user_one, user_two)
+    if success:
+        response_cache.invalidate(("friends", user_one), ("friends", user_two))
+
+    return respond(request, {
+        "success": success
+    })
+
+
+@routes.post("/block_friend")
+async def block_friend(request):
+    data = await request.post()
+    user_one = data['user_one']
+    user_two = data['user_two']
+
+    await database.block_friend(user_one, user_two)
+    response_cache.invalidate(("friends", user_one), ("friends", user_two))
+
+    return respond(request, {
+        "success": True
+    })
+
+
+@routes.get("/get_friends/{username}")
+async def get_friends(request):
+    username = request.match_info["username"]
+    since = request.query.get("since")
+
+    if since is not None:
+        delta = await database.run(operations.get_friends_delta, database.database, username, since)
+        return respond(request, delta)
+
+    friends_list = partial(operations.get_friends_list, database.database, username)
+    friends = await database.run(response_cache.get_or_compute, ("friends", username), friends_list)
+
+    return respond(request, friends)
+
+
+@routes.get("/cache_stats")
+async def cache_stats(request):
+    return respond(request, response_cache.stats())
+
+
+def respond(request, data, status=200, headers=None):
+    """ Like web.json_response, but as MessagePack and/or compressed when the request's Accept headers allow it """
+    body, wire_headers = wire_format.encode(data, request.headers.get("Accept", ""), request.headers.get("Accept-Encoding", ""))
+    wire_headers.update(headers or {})
+
+    return web.Response(body=body, status=status, headers=wire_headers)
+
+
+async def invalidate_user(username):
+    keys = [("avatar", username)]
+    keys.extend(("friends", friend) for friend in await database.get_friends(username))
+
+    response_cache.invalidate(*keys)
+    response_cache.invalidate_prefix(("all_users",))
+
+
+def create_app():
+    # aiohttp answers anything bigger with 413 before it is read into memory
+    app = web.Application(client_max_size=AvatarStore.max_upload_bytes)
+    app.add_routes(routes)
+
+    return app
+
+
+if __name__ == '__main__':
+    web.run_app(create_app(), host="127.0.0.1", port=int(os.environ.get("CHAT_ASYNC_PORT", 5001)))
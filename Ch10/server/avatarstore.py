@@ -0,0 +1,84 @@
+import hashlib
+import io
+import os
+import re
+import threading
+
+from PIL import Image
+
+avatars_dir = os.path.abspath(os.path.join(os.path.dirname(__file__), 'avatars/'))
+
+
+class AvatarStore:
+    """ Avatar images saved on disk under the SHA-256 of their contents, with smaller copies made on demand """
+
+    hash_pattern = re.compile("[0-9a-f]{64}")
+    sizes = (32, 64, 128)
+    # clients upload at most 512 x 512, which as PNG is well under this
+    max_upload_bytes = 4 * 1024 * 1024
+
+    def __init__(self, directory=avatars_dir):
+        self.directory = directory
+        os.makedirs(self.directory, exist_ok=True)
+
+        for size in self.sizes:
+            os.makedirs(os.path.join(self.directory, str(size)), exist_ok=True)
+
+    def is_valid_hash(self, avatar_hash):
+        return bool(self.hash_pattern.fullmatch(avatar_hash or ""))
+
+    def path(self, avatar_hash, size=None):
+        """ The uploaded original, or its copy shrunk to fit size x size """
+        if size is None:
+            return os.path.join(self.directory, f"{avatar_hash}.png")
+
+        return os.path.join(self.directory, str(size), f"{avatar_hash}.png")
+
+    def write(self, path, image_bytes):
+        # write then rename so a reader never sees half a file; the temp name is per thread as two may race to make one size
+        temp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(temp_path, "wb") as avatar_file:
+            avatar_file.write(image_bytes)
+        os.replace(temp_path, path)
+
+    def check_image(self, image_bytes):
+        """ ValueError unless image_bytes is a PNG that Pillow can read, so nothing broken is ever saved and served """
+        if len(image_bytes) > self.max_upload_bytes:
+            raise ValueError(f"Avatar is larger than {self.max_upload_bytes} bytes")
+
+        try:
+            with Image.open(io.BytesIO(image_bytes)) as image:
+                image_format = image.format
+                image.verify()
+        except (OSError, SyntaxError, Image.DecompressionBombError) as e:
+            raise ValueError("Avatar is not a valid image") from e
+
+        if image_format != "PNG":
+            raise ValueError("Avatar must be a PNG")
+
+    def save(self, image_bytes):
+        """ Checks then saves image_bytes, returning its hash; ValueError if it is not a valid PNG """
+        self.check_image(image_bytes)
+
+        avatar_hash = hashlib.sha256(image_bytes).hexdigest()
+        path = self.path(avatar_hash)
+
+        if not os.path.exists(path):
+            self.write(path, image_bytes)
+
+        return avatar_hash
+
+    def sized_path(self, avatar_hash, size):
+        """ Path of the size copy of avatar_hash, made the first time it is asked for; FileNotFoundError if there is no original, OSError if it cannot be read """
+        path = self.path(avatar_hash, size)
+
+        if not os.path.exists(path):
+            with Image.open(self.path(avatar_hash)) as image:
+                image.thumbnail((size, size), Image.LANCZOS)
+
+                output = io.BytesIO()
+                image.save(output, "PNG", optimize=True)
+
+            self.write(path, output.getvalue())
+
+        return path
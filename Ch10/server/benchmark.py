@@ -0,0 +1,67 @@
+import os
+import sys
+import tempfile
+import time
+
+import server
+
+from create_database import create_database
+from database import Database
+from response_cache import ResponseCache
+
+
+def populate(database, users=200, friends_per_user=20):
+    for i in range(users):
+        database.add_user(f"user{i}", f"User {i}")
+
+    for i in range(users):
+        for j in range(1, friends_per_user // 2 + 1):
+            database.add_friend(f"user{i}", f"user{(i + j) % users}")
+
+
+def requests_per_second(client, endpoint, method="GET", data=None, duration=3):
+    count = 0
+    end = time.perf_counter() + duration
+
+    while time.perf_counter() < end:
+        if method == "GET":
+            client.get(endpoint)
+        else:
+            client.post(endpoint, data=data)
+        count += 1
+
+    return count / duration
+
+
+def run(pool_size, database_path, duration):
+    server.database = Database(database_path, pool_size=pool_size)
+    # a cache that keeps nothing, so every request reaches the database rather than timing cache hits
+    server.response_cache = ResponseCache(max_entries=0)
+    client = server.app.test_client()
+
+    results = {
+        "/get_friends": requests_per_second(client, "/get_friends/user1", duration=duration),
+        "/user_exists": requests_per_second(client, "/user_exists", "POST", {"username": "user1"}, duration),
+    }
+
+    if server.database.pool:
+        server.database.pool.close()
+
+    return results
+
+
+if __name__ == '__main__':
+    duration = float(sys.argv[1]) if len(sys.argv) > 1 else 3
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        database_path = os.path.join(temp_dir, "benchmark.db")
+        create_database(database_path)
+        populate(Database(database_path, pool_size=0))
+
+        before = run(0, database_path, duration)
+        after = run(5, database_path, duration)
+
+    print(f"{'endpoint':<15}{'no pool':>12}{'pooled':>12}{'speedup':>10}")
+    for endpoint in before:
+        speedup = after[endpoint] / before[endpoint]
+        print(f"{endpoint:<15}{before[endpoint]:>10.0f}/s{after[endpoint]:>10.0f}/s{speedup:>9.2f}x")
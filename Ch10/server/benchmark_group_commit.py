@@ -0,0 +1,60 @@
+import os
+import sys
+import tempfile
+import threading
+import time
+
+from conversation import Conversation
+from create_database import create_database
+from database import Database
+from message_writer import MessageWriter
+
+
+def commit_each(database):
+    """ What send_message did before MessageWriter: one insert and one fsync per request """
+    def send(conversation_id, author, message, date_sent):
+        return Conversation(database, conversation_id).add_message(author, message, date_sent)
+
+    return send
+
+
+def messages_per_second(send, senders, duration):
+    counts = [0] * senders
+    end = time.perf_counter() + duration
+
+    def sender(index):
+        conversation_id = f"user{index}_user{index + 1}"
+        while time.perf_counter() < end:
+            send(conversation_id, f"user{index}", "a message in a busy conversation", 1500000000)
+            counts[index] += 1
+
+    threads = [threading.Thread(target=sender, args=(i,)) for i in range(senders)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    return sum(counts) / duration
+
+
+if __name__ == '__main__':
+    duration = float(sys.argv[1]) if len(sys.argv) > 1 else 3
+
+    print(f"{'senders':<10}{'commit each':>14}{'group commit':>14}{'speedup':>10}{'avg batch':>11}")
+
+    for senders in (1, 10, 100):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            database_path = os.path.join(temp_dir, "benchmark.db")
+            create_database(database_path)
+
+            database = Database(database_path, pool_size=senders, synchronous="FULL")
+            before = messages_per_second(commit_each(database), senders, duration)
+            database.pool.close()
+
+            writer = MessageWriter(Database(database_path, pool_size=1, synchronous="FULL"))
+            after = messages_per_second(writer.write, senders, duration)
+            writer.close()
+            writer.database.pool.close()
+
+        average_batch = writer.messages / writer.batches
+        print(f"{senders:<10}{before:>12.0f}/s{after:>12.0f}/s{after / before:>9.2f}x{average_batch:>11.1f}")
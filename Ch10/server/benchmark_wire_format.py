@@ -0,0 +1,92 @@
+import gzip
+import json
+import os
+import sys
+import tempfile
+import time
+
+import server
+import wire_format
+
+from benchmark import populate
+from conversation import Conversation, get_conversation_id_for_users
+from create_database import create_database
+from database import Database
+
+
+# (name, Accept, Accept-Encoding)
+formats = [
+    ("json", "application/json", "identity"),
+    ("json + gzip", "application/json", "gzip"),
+    ("msgpack", "application/msgpack", "identity"),
+    ("msgpack + gzip", "application/msgpack", "gzip"),
+]
+
+
+def add_history(database, messages=500):
+    conversation = Conversation(database, get_conversation_id_for_users({"user_one": "user1", "user_two": "user2"}))
+
+    for i in range(messages):
+        author = "user1" if i % 2 else "user2"
+        conversation.add_message(author, f"message number {i}, with a little more text than a quick reply", 1500000000 + i)
+
+
+def decode(response):
+    body = response.get_data()
+
+    if response.headers.get("Content-Encoding") == "gzip":
+        body = gzip.decompress(body)
+
+    if response.headers["Content-Type"] == wire_format.MSGPACK_TYPE:
+        return wire_format.msgpack.unpackb(body, raw=False)
+
+    return json.loads(body)
+
+
+def measure(client, method, endpoint, data, accept, accept_encoding, repeats):
+    headers = {"Accept": accept, "Accept-Encoding": accept_encoding}
+
+    if method == "GET":
+        response = client.get(endpoint, headers=headers)
+    else:
+        response = client.post(endpoint, data=data, headers=headers)
+
+    start = time.perf_counter()
+    for i in range(repeats):
+        decode(response)
+    parse_seconds = (time.perf_counter() - start) / repeats
+
+    return len(response.get_data()), parse_seconds
+
+
+if __name__ == '__main__':
+    repeats = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        database_path = os.path.join(temp_dir, "benchmark.db")
+        create_database(database_path)
+        populate(Database(database_path, pool_size=0), friends_per_user=200)
+        add_history(Database(database_path, pool_size=0))
+
+        server.database = Database(database_path)
+        client = server.app.test_client()
+
+        payloads = {
+            "history": ("POST", "/get_message_history", {"user_one": "user1", "user_two": "user2", "limit": 500}),
+            "friends": ("GET", "/get_friends/user1", None),
+        }
+
+        print(f"{'payload':<10}{'format':<16}{'bytes':>10}{'vs json':>10}{'parse ms':>10}")
+        for payload, (method, endpoint, data) in payloads.items():
+            json_size = None
+
+            for name, accept, accept_encoding in formats:
+                if "msgpack" in name and wire_format.msgpack is None:
+                    print(f"{payload:<10}{name:<16}{'msgpack is not installed':>30}")
+                    continue
+
+                size, parse_seconds = measure(client, method, endpoint, data, accept, accept_encoding, repeats)
+                json_size = json_size or size
+                print(f"{payload:<10}{name:<16}{size:>10}{size / json_size:>9.0%}{parse_seconds * 1000:>10.3f}")
+
+        server.database.pool.close()
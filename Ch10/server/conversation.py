@@ -1,48 +1,74 @@
-import arrow
-import sqlite3
-
-
 class Conversation:
-    def __init__(self, database):
+    def __init__(self, database, conversation_id):
         self.database = database
+        self.conversation_id = conversation_id
+
+    def get_history_page(self, before_id=None, limit=50):
+        """ The newest limit messages older than before_id, oldest first, and whether there are more before them """
+        if before_id is None:
+            sql = "SELECT id, author, message, date_sent FROM messages WHERE conversation_id=? ORDER BY id DESC LIMIT ?"
+            params = (self.conversation_id, limit + 1)
+        else:
+            sql = "SELECT id, author, message, date_sent FROM messages WHERE conversation_id=? AND id < ? ORDER BY id DESC LIMIT ?"
+            params = (self.conversation_id, int(before_id), limit + 1)
 
-    def initialise_table(self):
-        sql = "CREATE TABLE conversation (author text, message text, date_sent text)"
-        conn = sqlite3.connect(self.database)
-        cursor = conn.cursor()
-        cursor.execute(sql)
-        conn.commit()
-        conn.close()
-
-    def get_history(self):
-        sql = "SELECT * FROM conversation"
-        conn = sqlite3.connect(self.database)
-        conn.row_factory = sqlite3.Row
-        cursor = conn.cursor()
-        cursor.execute(sql)
-        results = [dict(row) for row in cursor.fetchall()]
-        conn.close()
-
-        return results
+        messages = self.database.perform_select(sql, params)
+        has_more = len(messages) > limit
+
+        return list(reversed(messages[:limit])), has_more
 
     def add_message(self, author, message, date_sent):
-        sql = "INSERT INTO conversation VALUES (?, ?, ?)"
-        params = (author, message, date_sent)
-        conn = sqlite3.connect(self.database)
-        cursor = conn.cursor()
-        cursor.execute(sql, params)
-        conn.commit()
-        conn.close()
+        sql = "INSERT INTO messages (conversation_id, author, message, date_sent) VALUES (?, ?, ?, ?)"
+        params = (self.conversation_id, author, message, int(date_sent))
+
+        return self.database.perform_insert(sql, params)
+
+    def get_messages_after(self, message_id):
+        """ Seeks on the (conversation_id, id) index, so only the new rows are read """
+        sql = "SELECT id, author, message FROM messages WHERE conversation_id=? AND id > ? ORDER BY id"
+        params = (self.conversation_id, int(message_id))
+
+        return self.database.perform_select(sql, params)
 
     def get_new_messages(self, timestamp, username):
-        sql = "SELECT author, message FROM conversation WHERE date_sent > ? AND author <> ?"
-        params = (timestamp, username)
+        sql = "SELECT id, author, message FROM messages WHERE conversation_id=? AND date_sent > ? AND author <> ? ORDER BY id"
+        params = (self.conversation_id, int(timestamp), username)
+
+        return self.database.perform_select(sql, params)
+
+    @staticmethod
+    def get_messages_after_many(database, cursors):
+        """ cursors maps conversation_id to the last message id the client has for it """
+        if not cursors:
+            return []
+
+        conditions = " OR ".join(["(conversation_id=? AND id > ?)" for conversation_id in cursors])
+        sql = f"SELECT id, conversation_id, author, message FROM messages WHERE {conditions} ORDER BY id"
+        params = []
+        for conversation_id, message_id in cursors.items():
+            params.extend([conversation_id, int(message_id)])
+
+        return database.perform_select(sql, params)
+
+
+def get_conversation_id_for_users(data):
+    user_one = data["user_one"]
+    user_two = data["user_two"]
+
+    users_in_order = sorted([user_one, user_two])
+    conversation_id = "_".join(users_in_order)
+
+    return conversation_id
+
+
+def collect_new_messages(database, requester_username, cursors):
+    """ Advances cursors in place and returns the friends' messages for each conversation """
+    new_messages = {conversation_id: [] for conversation_id in cursors}
 
-        conn = sqlite3.connect(self.database)
-        conn.row_factory = sqlite3.Row
-        cursor = conn.cursor()
-        cursor.execute(sql, params)
-        results = [dict(row) for row in cursor.fetchall()]
-        conn.close()
+    for message in Conversation.get_messages_after_many(database, cursors):
+        conversation_id = message.pop("conversation_id")
+        cursors[conversation_id] = message["id"]
+        if message["author"] != requester_username:
+            new_messages[conversation_id].append(message)
 
-        return results
\ No newline at end of file
+    return new_messages
@@ -1,10 +1,51 @@
 import sqlite3
 
-database = sqlite3.connect("chat.db")
-cursor = database.cursor()
+friends_index_sql = [
+    "CREATE INDEX friends_user_one ON friends (user_one, blocked)",
+    "CREATE INDEX friends_user_two ON friends (user_two, blocked)",
+    # one row per pair, whichever way round it was added
+    "CREATE UNIQUE INDEX friends_pair ON friends (min(user_one, user_two), max(user_one, user_two))",
+]
 
-create_users_sql = "CREATE TABLE users (username TEXT, real_name TEXT)"
-cursor.execute(create_users_sql)
+# IF NOT EXISTS so tools run against an older chat.db can add the shared messages table too
+messages_sql = [
+    "CREATE TABLE IF NOT EXISTS messages (id INTEGER PRIMARY KEY, conversation_id TEXT, author TEXT, message TEXT, date_sent INTEGER)",
+    "CREATE INDEX IF NOT EXISTS messages_conversation_id ON messages (conversation_id, id)",
+    "CREATE INDEX IF NOT EXISTS messages_conversation_date ON messages (conversation_id, date_sent)",
+]
 
-database.commit()
-database.close()
+
+def create_database(path="chat.db"):
+    database = sqlite3.connect(path)
+    cursor = database.cursor()
+
+    create_users_sql = "CREATE TABLE users (username TEXT, real_name TEXT, avatar_hash TEXT)"
+    cursor.execute(create_users_sql)
+
+    create_users_index_sql = "CREATE INDEX users_username ON users (username)"
+    cursor.execute(create_users_index_sql)
+
+    create_real_name_index_sql = "CREATE INDEX users_real_name ON users (real_name COLLATE NOCASE)"
+    cursor.execute(create_real_name_index_sql)
+
+    create_friends_sql = "CREATE TABLE friends (user_one TEXT, user_two TEXT, blocked INTEGER)"
+    cursor.execute(create_friends_sql)
+
+    for sql in friends_index_sql:
+        cursor.execute(sql)
+
+    create_friend_changes_sql = "CREATE TABLE friend_changes (id INTEGER PRIMARY KEY, username TEXT, friend TEXT)"
+    cursor.execute(create_friend_changes_sql)
+
+    create_friend_changes_index_sql = "CREATE INDEX friend_changes_username ON friend_changes (username, id)"
+    cursor.execute(create_friend_changes_index_sql)
+
+    for sql in messages_sql:
+        cursor.execute(sql)
+
+    database.commit()
+    database.close()
+
+
+if __name__ == '__main__':
+    create_database()
@@ -1,24 +1,140 @@
+import queue
 import sqlite3
+import threading
+
+from contextlib import contextmanager
+
+
+class ConnectionPool:
+    def __init__(self, database, size=5, timeout=10, cached_statements=256, synchronous="NORMAL"):
+        """ synchronous="FULL" makes each commit wait for an fsync, so a committed row survives a power cut """
+        self.database = database
+        self.size = size
+        self.timeout = timeout
+        self.cached_statements = cached_statements
+        self.synchronous = synchronous
+
+        self.connections = queue.LifoQueue(maxsize=size)
+        self.created = 0
+        self.lock = threading.Lock()
+
+    def create_connection(self):
+        conn = sqlite3.connect(
+            self.database,
+            timeout=self.timeout,
+            check_same_thread=False,
+            cached_statements=self.cached_statements,
+        )
+        conn.row_factory = sqlite3.Row
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute(f"PRAGMA synchronous={self.synchronous}")
+
+        return conn
+
+    def acquire(self):
+        try:
+            return self.connections.get_nowait()
+        except queue.Empty:
+            pass
+
+        with self.lock:
+            if self.created < self.size:
+                self.created += 1
+                return self.create_connection()
+
+        return self.connections.get(timeout=self.timeout)
+
+    def release(self, conn):
+        if conn.in_transaction:
+            conn.rollback()
+
+        self.connections.put_nowait(conn)
+
+    @contextmanager
+    def connection(self):
+        conn = self.acquire()
+        try:
+            yield conn
+        finally:
+            self.release(conn)
+
+    def close(self):
+        while True:
+            try:
+                conn = self.connections.get_nowait()
+            except queue.Empty:
+                break
+            conn.close()
+
+        with self.lock:
+            self.created = 0
 
 
 class Database:
-    def __init__(self):
-        self.database = "chat.db"
+    def __init__(self, database="chat.db", pool_size=5, synchronous="NORMAL"):
+        """ pool_size=0 opens a fresh connection for every query """
+        self.database = database
+        self.pool_size = pool_size
+
+        if pool_size:
+            self.pool = ConnectionPool(database, size=pool_size, synchronous=synchronous)
+        else:
+            self.pool = None
+
+        self.local = threading.local()
+
+    @property
+    def in_transaction(self):
+        return getattr(self.local, "transaction", None) is not None
+
+    @contextmanager
+    def transaction(self, immediate=False):
+        """ Run every query made on this thread inside the block on one connection, committing at the end """
+        if self.in_transaction:
+            yield self.local.transaction
+            return
+
+        with self.connection() as conn:
+            conn.execute("BEGIN IMMEDIATE" if immediate else "BEGIN")
+            self.local.transaction = conn
+            try:
+                yield conn
+                conn.commit()
+            except Exception:
+                conn.rollback()
+                raise
+            finally:
+                self.local.transaction = None
+
+    @contextmanager
+    def connection(self):
+        if self.in_transaction:
+            yield self.local.transaction
+        elif self.pool:
+            with self.pool.connection() as conn:
+                yield conn
+        else:
+            conn = sqlite3.connect(self.database)
+            conn.row_factory = sqlite3.Row
+            try:
+                yield conn
+            finally:
+                conn.close()
 
     def perform_insert(self, sql, params):
-        conn = sqlite3.connect(self.database)
-        cursor = conn.cursor()
-        cursor.execute(sql, params)
-        conn.commit()
-        conn.close()
+        with self.connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute(sql, params)
+            if not self.in_transaction:
+                conn.commit()
+
+        return cursor.lastrowid
 
     def perform_select(self, sql, params):
-        conn = sqlite3.connect(self.database)
-        conn.row_factory = sqlite3.Row
-        cursor = conn.cursor()
-        cursor.execute(sql, params)
-        results = [dict(row) for row in cursor.fetchall()]
-        conn.close()
+        with self.connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute(sql, params)
+            results = [dict(row) for row in cursor.fetchall()]
 
         return results
 
@@ -28,9 +144,23 @@ class Database:
 
         self.perform_insert(sql, query_params)
 
-    def get_all_users(self):
-        sql = "SELECT username, real_name, avatar FROM users"
-        params = []
+    def search_users(self, prefix="", after="", limit=100):
+        """ Users whose username or real name starts with prefix, in username order after the cursor """
+        if prefix:
+            # prefix + the highest code point is an upper bound, so each side of the UNION is an index range scan
+            sql = (
+                "SELECT username, real_name, avatar_hash FROM users "
+                "WHERE username >= ? AND username < ? AND username > ? "
+                "UNION "
+                "SELECT username, real_name, avatar_hash FROM users "
+                "WHERE real_name >= ? COLLATE NOCASE AND real_name < ? COLLATE NOCASE AND username > ? "
+                "ORDER BY username LIMIT ?"
+            )
+            prefix_end = prefix + chr(0x10FFFF)
+            params = (prefix, prefix_end, after, prefix, prefix_end, after, limit)
+        else:
+            sql = "SELECT username, real_name, avatar_hash FROM users WHERE username > ? ORDER BY username LIMIT ?"
+            params = (after, limit)
 
         return self.perform_select(sql, params)
 
@@ -45,43 +175,58 @@ class Database:
 
         return False
 
-    def update_avatar(self, username, img_b64):
-        sql = "UPDATE users SET avatar=? WHERE username=?"
-        params = (img_b64, username)
+    def update_avatar(self, username, avatar_hash):
+        sql = "UPDATE users SET avatar_hash=? WHERE username=?"
+        params = (avatar_hash, username)
 
-        return self.perform_insert(sql, params)
+        with self.transaction():
+            self.perform_insert(sql, params)
+            # the new hash changes this user's row in each of their friends' lists
+            for friend in self.get_friends(username):
+                self.log_friend_change(friend, username)
 
     def get_user_avatar(self, username):
-        sql = "SELECT avatar FROM users WHERE username=?"
+        sql = "SELECT avatar_hash FROM users WHERE username=?"
         params = (username,)
 
         return self.perform_select(sql, params)
 
     def add_friend(self, user_one, user_two):
-        sql = "INSERT INTO friends (user_one, user_two, blocked) VALUES (?,?,0)"
-        query_params = (user_one, user_two)
+        # friends_pair makes the insert a no-op for a pair that already has a row, e.g. a blocked one
+        insert_sql = "INSERT OR IGNORE INTO friends (user_one, user_two, blocked) VALUES (?,?,0)"
+        unblock_sql = "UPDATE friends SET blocked=0 WHERE (user_one = ? AND user_two = ?) OR (user_two = ? AND user_one = ?)"
 
-        self.perform_insert(sql, query_params)
+        with self.transaction():
+            self.perform_insert(insert_sql, (user_one, user_two))
+            self.perform_insert(unblock_sql, (user_one, user_two, user_one, user_two))
+            self.log_friend_change(user_one, user_two)
+            self.log_friend_change(user_two, user_one)
 
     def get_friends(self, username):
-        all_friends = []
-        sql = "SELECT user_two FROM friends WHERE user_one=? AND blocked=0"
-        params = (username,)
-        friends = self.perform_select(sql, params)
+        sql = (
+            "SELECT user_two AS friend FROM friends WHERE user_one=? AND blocked=0 "
+            "UNION "
+            "SELECT user_one AS friend FROM friends WHERE user_two=? AND blocked=0"
+        )
+        params = (username, username)
 
-        sql = "SELECT user_one FROM friends WHERE user_two=? AND blocked=0"
-        friends2 = self.perform_select(sql, params)
+        return [row["friend"] for row in self.perform_select(sql, params)]
 
-        for friend in friends:
-            all_friends.append(friend["user_two"])
-        for friend in friends2:
-            all_friends.append(friend["user_one"])
+    def get_friend_details(self, username):
+        sql = (
+            "SELECT users.username, users.real_name, users.avatar_hash FROM users JOIN ("
+            "SELECT user_two AS friend FROM friends WHERE user_one=? AND blocked=0 "
+            "UNION "
+            "SELECT user_one AS friend FROM friends WHERE user_two=? AND blocked=0"
+            ") AS friend_names ON users.username = friend_names.friend"
+        )
+        params = (username, username)
 
-        return all_friends
+        return self.perform_select(sql, params)
 
     def get_users_by_usernames(self, usernames):
         question_marks = ','.join(['?' for user in usernames])
-        sql = f"SELECT * FROM users WHERE username IN ({question_marks})"
+        sql = f"SELECT username, real_name, avatar_hash FROM users WHERE username IN ({question_marks})"
         params = [user for user in usernames]
 
         friends = self.perform_select(sql, params)
@@ -92,4 +237,26 @@ class Database:
         sql = "UPDATE friends SET blocked=1 WHERE (user_one = ? AND user_two = ?) OR (user_two = ? AND user_one = ?)"
         query_params = (username, contact_to_block, username, contact_to_block)
 
+        with self.transaction():
+            self.perform_insert(sql, query_params)
+            self.log_friend_change(username, contact_to_block)
+            self.log_friend_change(contact_to_block, username)
+
+    def log_friend_change(self, username, friend):
+        """ Record that friend's row in username's friends list was added, removed or updated """
+        sql = "INSERT INTO friend_changes (username, friend) VALUES (?,?)"
+        query_params = (username, friend)
+
         self.perform_insert(sql, query_params)
+
+    def get_friends_version(self, username):
+        sql = "SELECT MAX(id) AS version FROM friend_changes WHERE username=?"
+        params = (username,)
+
+        return self.perform_select(sql, params)[0]["version"] or 0
+
+    def get_friend_changes(self, username, since_version):
+        sql = "SELECT DISTINCT friend FROM friend_changes WHERE username=? AND id > ?"
+        params = (username, int(since_version))
+
+        return [row["friend"] for row in self.perform_select(sql, params)]
@@ -0,0 +1,89 @@
+"""
+Compare the Flask server with async_server.py while both hold many idle long-polls.
+
+    python server.py                # http://127.0.0.1:5000
+    python async_server.py          # http://127.0.0.1:5001
+    python load_test.py http://127.0.0.1:5000 http://127.0.0.1:5001 --idle 10000
+
+Holding tens of thousands of connections needs a raised open file limit (ulimit -n) on both ends.
+"""
+import argparse
+import asyncio
+import time
+
+import aiohttp
+
+
+async def hold_idle_connection(session, url, index, hold_seconds):
+    params = {
+        "username": f"idle_listener_{index}",
+        "conversations": {"nobody": 0},
+        "timeout": hold_seconds,
+    }
+
+    try:
+        async with session.post(url + "/wait_for_messages_batch", json=params) as response:
+            await response.read()
+            return response.status == 200
+    except aiohttp.ClientError:
+        return False
+
+
+async def measure_throughput(session, url, endpoint, method, data, concurrency, duration):
+    completed = 0
+    failed = 0
+    end = time.monotonic() + duration
+
+    async def worker():
+        nonlocal completed, failed
+        while time.monotonic() < end:
+            try:
+                async with session.request(method, url + endpoint, data=data) as response:
+                    await response.read()
+                    completed += 1
+            except aiohttp.ClientError:
+                failed += 1
+
+    await asyncio.gather(*[worker() for i in range(concurrency)])
+
+    return completed / duration, failed
+
+
+async def run(url, idle, concurrency, duration):
+    connector = aiohttp.TCPConnector(limit=0)
+    timeout = aiohttp.ClientTimeout(total=duration + 30)
+
+    async with aiohttp.ClientSession(connector=connector, timeout=timeout) as session:
+        hold_seconds = duration + 5
+        idle_tasks = [asyncio.ensure_future(hold_idle_connection(session, url, i, hold_seconds)) for i in range(idle)]
+
+        # give the idle long-polls time to connect before measuring
+        await asyncio.sleep(min(5, 1 + idle / 2000))
+
+        results = {
+            "/user_exists": await measure_throughput(session, url, "/user_exists", "POST", {"username": "user1"}, concurrency, duration),
+            "/get_friends": await measure_throughput(session, url, "/get_friends/user1", "GET", None, concurrency, duration),
+        }
+
+        held = sum(await asyncio.gather(*idle_tasks))
+
+    return results, held
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("urls", nargs="+")
+    parser.add_argument("--idle", type=int, default=1000, help="idle long-poll connections to hold open")
+    parser.add_argument("--concurrency", type=int, default=50)
+    parser.add_argument("--duration", type=float, default=10)
+    args = parser.parse_args()
+
+    print(f"{'server':<28}{'endpoint':<16}{'req/s':>10}{'errors':>8}{'idle held':>12}")
+    for url in args.urls:
+        results, held = asyncio.get_event_loop().run_until_complete(run(url, args.idle, args.concurrency, args.duration))
+        for endpoint, (rate, failed) in results.items():
+            print(f"{url:<28}{endpoint:<16}{rate:>10.0f}{failed:>8}{held:>7}/{args.idle}")
+
+
+if __name__ == '__main__':
+    main()
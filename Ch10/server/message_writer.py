@@ -0,0 +1,142 @@
+import queue
+import threading
+import time
+
+from concurrent.futures import Future
+
+from conversation import Conversation
+
+
+class MessageWriter:
+    """ Commits messages sent by concurrent requests together, so a burst of messages costs one fsync """
+
+    def __init__(self, database, flush_interval=0.0, max_batch=256):
+        """
+        database should use synchronous="FULL" so a commit is on disk before the sender is acknowledged.
+        After the first message of a batch arrives, others are gathered for up to flush_interval
+        seconds, or until there are max_batch of them, before the batch is committed. With the
+        default of 0 the batch is whatever queued up while the previous commit was syncing.
+        A message written while nothing else is queued or committing skips the queue altogether.
+        """
+        self.database = database
+        self.flush_interval = flush_interval
+        self.max_batch = max_batch
+
+        self.pending = queue.Queue()
+        self.batches = 0
+        self.messages = 0
+
+        # commits under way on any thread, the writer's or a sender's own
+        self.commits = 0
+        self.lock = threading.Lock()
+
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def submit(self, conversation_id, author, message, date_sent):
+        """ Returns a Future that resolves to the message's id once it has been committed """
+        future = Future()
+        self.pending.put((future, conversation_id, author, message, date_sent))
+
+        return future
+
+    def write(self, conversation_id, author, message, date_sent, timeout=None):
+        """ Blocks until the message is committed and returns its id """
+        if not self.start_inline_commit():
+            return self.submit(conversation_id, author, message, date_sent).result(timeout)
+
+        # alone, a sender commits on its own thread rather than paying two thread handoffs for a batch of one
+        try:
+            with self.database.transaction(immediate=True):
+                message_id = self.insert(conversation_id, author, message, date_sent)
+        finally:
+            self.finish_commit(1)
+
+        return message_id
+
+    def is_idle(self):
+        return self.commits == 0 and self.pending.empty()
+
+    def start_inline_commit(self):
+        with self.lock:
+            if not self.is_idle():
+                return False
+
+            self.commits += 1
+            return True
+
+    def finish_commit(self, messages):
+        with self.lock:
+            self.commits -= 1
+            self.batches += 1
+            self.messages += messages
+
+    def close(self):
+        self.pending.put(None)
+        self.thread.join()
+
+    def next_batch(self):
+        first = self.pending.get()
+        if first is None:
+            return None
+
+        batch = [first]
+        deadline = time.monotonic() + self.flush_interval
+
+        while len(batch) < self.max_batch:
+            try:
+                # whatever queued up during the last commit is taken straight away
+                item = self.pending.get_nowait()
+            except queue.Empty:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+
+                try:
+                    item = self.pending.get(timeout=remaining)
+                except queue.Empty:
+                    break
+
+            if item is None:
+                self.pending.put(None)
+                break
+
+            batch.append(item)
+
+        return batch
+
+    def run(self):
+        while True:
+            batch = self.next_batch()
+            if batch is None:
+                return
+
+            with self.lock:
+                self.commits += 1
+
+            try:
+                with self.database.transaction(immediate=True):
+                    ids = [self.insert(*item[1:]) for item in batch]
+            except Exception:
+                # one bad message should not fail everyone else's, so retry them one at a time
+                for item in batch:
+                    self.write_one(item)
+            else:
+                for (future, *message), message_id in zip(batch, ids):
+                    future.set_result(message_id)
+
+            self.finish_commit(len(batch))
+
+    def write_one(self, item):
+        future, *message = item
+
+        try:
+            with self.database.transaction(immediate=True):
+                message_id = self.insert(*message)
+        except Exception as e:
+            future.set_exception(e)
+        else:
+            future.set_result(message_id)
+
+    def insert(self, conversation_id, author, message, date_sent):
+        return Conversation(self.database, conversation_id).add_message(author, message, date_sent)
@@ -0,0 +1,72 @@
+import os
+import sqlite3
+import sys
+
+from create_database import messages_sql
+
+conversations_dir = os.path.abspath(os.path.join(os.path.dirname(__file__), 'conversations/'))
+
+
+def migrate_conversations(database_path="chat.db", source_dir=conversations_dir, batch_size=500):
+    """
+    Copy every per-pair conversation database into the shared messages table.
+    Run it before the server starts on the shared table: ids give history its order, so the imported
+    messages must come before any sent since. It refuses to run once the server has written messages.
+    """
+    conn = sqlite3.connect(database_path)
+    cursor = conn.cursor()
+
+    # a chat.db from before the shared table has no messages table yet
+    for sql in messages_sql:
+        cursor.execute(sql)
+
+    # committed along with each conversation's messages, so an interrupted run picks up where it stopped
+    cursor.execute("CREATE TABLE IF NOT EXISTS migrated_conversations (conversation_id TEXT PRIMARY KEY)")
+
+    cursor.execute("SELECT 1 FROM messages WHERE conversation_id NOT IN (SELECT conversation_id FROM migrated_conversations) LIMIT 1")
+    if cursor.fetchone():
+        conn.close()
+        raise RuntimeError("messages already holds messages sent through the server, and older history imported now would be ordered after them")
+
+    conversation_files = sorted(file for file in os.listdir(source_dir) if file.endswith(".db"))
+    migrated = 0
+    skipped = 0
+
+    for index, file in enumerate(conversation_files, start=1):
+        conversation_id = file[:-len(".db")]
+
+        cursor.execute("SELECT 1 FROM migrated_conversations WHERE conversation_id=?", (conversation_id,))
+        if cursor.fetchone():
+            skipped += 1
+            continue
+
+        legacy = sqlite3.connect(os.path.join(source_dir, file))
+        rows = legacy.execute("SELECT author, message, date_sent FROM conversation ORDER BY rowid")
+        cursor.executemany(
+            "INSERT INTO messages (conversation_id, author, message, date_sent) VALUES (?, ?, ?, CAST(? AS INTEGER))",
+            ((conversation_id, *row) for row in rows)
+        )
+        legacy.close()
+        cursor.execute("INSERT INTO migrated_conversations (conversation_id) VALUES (?)", (conversation_id,))
+        migrated += 1
+
+        # commit in batches so a large import is not one fsync per conversation
+        if index % batch_size == 0:
+            conn.commit()
+
+    conn.commit()
+    conn.close()
+
+    return migrated, skipped
+
+
+if __name__ == '__main__':
+    database_path = sys.argv[1] if len(sys.argv) > 1 else "chat.db"
+    source_dir = sys.argv[2] if len(sys.argv) > 2 else conversations_dir
+
+    try:
+        migrated, skipped = migrate_conversations(database_path, source_dir)
+    except RuntimeError as e:
+        sys.exit(f"Not migrating: {e}")
+
+    print(f"Migrated {migrated} conversations, skipped {skipped} already present")
@@ -0,0 +1,65 @@
+import asyncio
+import threading
+
+
+class MessageNotifier:
+    """ Wakes long-polling requests when a message arrives for their user """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.conditions = {}
+        self.versions = {}
+
+    def get_condition(self, username):
+        if username not in self.conditions:
+            self.conditions[username] = threading.Condition(self.lock)
+
+        return self.conditions[username]
+
+    def version(self, username):
+        with self.lock:
+            return self.versions.get(username, 0)
+
+    def notify(self, username):
+        with self.lock:
+            self.versions[username] = self.versions.get(username, 0) + 1
+            self.get_condition(username).notify_all()
+
+    def wait(self, username, version, timeout):
+        """ Block until username is notified after version, returning False on timeout """
+        with self.lock:
+            condition = self.get_condition(username)
+
+            return condition.wait_for(lambda: self.versions.get(username, 0) != version, timeout)
+
+
+class AsyncMessageNotifier:
+    """ MessageNotifier for the asyncio server, where waiting costs a coroutine rather than a thread """
+
+    def __init__(self):
+        self.events = {}
+        self.versions = {}
+
+    def version(self, username):
+        return self.versions.get(username, 0)
+
+    def notify(self, username):
+        self.versions[username] = self.version(username) + 1
+
+        event = self.events.pop(username, None)
+        if event:
+            event.set()
+
+    async def wait(self, username, version, timeout):
+        if self.version(username) != version:
+            return True
+
+        if username not in self.events:
+            self.events[username] = asyncio.Event()
+
+        try:
+            await asyncio.wait_for(self.events[username].wait(), timeout)
+        except asyncio.TimeoutError:
+            return False
+
+        return True
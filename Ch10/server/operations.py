@@ -0,0 +1,136 @@
+import json
+
+from conversation import Conversation, get_conversation_id_for_users
+
+
+def get_friends_list(database, username):
+    with database.transaction():
+        return {
+            "friends": database.get_friend_details(username),
+            "version": database.get_friends_version(username),
+        }
+
+
+def get_friends_delta(database, username, since_version):
+    """ Friends added or updated since since_version, and usernames that left the list """
+    with database.transaction():
+        version = database.get_friends_version(username)
+        changed_usernames = database.get_friend_changes(username, since_version)
+
+        if changed_usernames:
+            current_friends = set(database.get_friends(username))
+        else:
+            current_friends = set()
+
+        still_friends = [friend for friend in changed_usernames if friend in current_friends]
+        removed = [friend for friend in changed_usernames if friend not in current_friends]
+        changed = database.get_users_by_usernames(still_friends) if still_friends else []
+
+    return {"version": version, "changed": changed, "removed": removed}
+
+
+def users_as_ndjson(users, limit):
+    """ One JSON user per line, then {"next": cursor}, so clients can show users as they arrive """
+    for user in users[:limit]:
+        yield json.dumps(user) + "\n"
+
+    next_cursor = users[limit - 1]["username"] if len(users) > limit else None
+    yield json.dumps({"next": next_cursor}) + "\n"
+
+
+def add_friend(database, user_one, user_two):
+    with database.transaction(immediate=True):
+        if database.user_exists(user_two) and database.user_exists(user_one):
+            database.add_friend(user_one, user_two)
+            return True
+
+    return False
+
+
+def create_account(database, username, real_name):
+    # an immediate transaction stops two clients both seeing the name as free
+    with database.transaction(immediate=True):
+        if database.user_exists(username):
+            return False
+
+        database.add_user(username, real_name)
+
+    return True
+
+
+def get_message_history(database, params, default_limit=50, max_limit=500):
+    """ params holds user_one, user_two and optionally before_id and limit """
+    conversation = Conversation(database, get_conversation_id_for_users(params))
+
+    before_id = params.get("before_id")
+    limit = min(int(params.get("limit", default_limit)), max_limit)
+    history, has_more = conversation.get_history_page(before_id, limit)
+
+    return {"history": history, "has_more": has_more}
+
+
+def login(database, username):
+    with database.transaction():
+        if not database.user_exists(username):
+            return {"exists": False, "friends": [], "version": 0}
+
+        return dict(get_friends_list(database, username), exists=True)
+
+
+def batch_user_exists(database, params):
+    return database.user_exists(params["username"])
+
+
+def batch_add_user(database, params):
+    return create_account(database, params["username"], params["real_name"])
+
+
+def batch_get_friends(database, params):
+    return database.get_friend_details(params["username"])
+
+
+def batch_get_message_history(database, params):
+    return get_message_history(database, params)
+
+
+def batch_add_friend(database, params):
+    return add_friend(database, params["user_one"], params["user_two"])
+
+
+def batch_block_friend(database, params):
+    database.block_friend(params["user_one"], params["user_two"])
+
+    return True
+
+
+# name: (function, writes to the database)
+batch_operations = {
+    "user_exists": (batch_user_exists, False),
+    "add_user": (batch_add_user, True),
+    "get_friends": (batch_get_friends, False),
+    "get_message_history": (batch_get_message_history, False),
+    "add_friend": (batch_add_friend, True),
+    "block_friend": (batch_block_friend, True),
+}
+
+
+def batch_writes(operations):
+    return any(batch_operations[operation["op"]][1] for operation in operations if operation.get("op") in batch_operations)
+
+
+def run_batch(database, operations):
+    """ Run each {"op": name, "params": {...}} in order inside one transaction, returning their results """
+    if not isinstance(operations, list) or not all(isinstance(operation, dict) for operation in operations):
+        raise ValueError("operations must be a list of objects")
+
+    for operation in operations:
+        if operation.get("op") not in batch_operations:
+            raise ValueError(f"Unknown operation {operation.get('op')!r}")
+
+    with database.transaction(immediate=batch_writes(operations)):
+        results = []
+        for operation in operations:
+            function = batch_operations[operation["op"]][0]
+            results.append(function(database, operation.get("params", {})))
+
+    return results
@@ -0,0 +1,86 @@
+import threading
+import time
+
+from collections import OrderedDict
+
+
+class ResponseCache:
+    """ A read-through cache with a TTL and LRU eviction for responses that rarely change """
+
+    def __init__(self, max_entries=1024, ttl=60):
+        self.max_entries = max_entries
+        self.ttl = ttl
+
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        # bumped by every invalidation, so a value computed while one happened is never stored
+        self.generation = 0
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def get_or_compute(self, key, compute):
+        now = time.monotonic()
+
+        with self.lock:
+            if key in self.entries:
+                expires, value = self.entries[key]
+                if expires > now:
+                    self.entries.move_to_end(key)
+                    self.hits += 1
+                    return value
+
+                del self.entries[key]
+                self.expirations += 1
+
+            self.misses += 1
+            generation = self.generation
+
+        value = compute()
+
+        with self.lock:
+            if generation == self.generation:
+                self.entries[key] = (now + self.ttl, value)
+                self.entries.move_to_end(key)
+
+                while len(self.entries) > self.max_entries:
+                    self.entries.popitem(last=False)
+                    self.evictions += 1
+
+        return value
+
+    def invalidate(self, *keys):
+        with self.lock:
+            self.generation += 1
+            for key in keys:
+                self.entries.pop(key, None)
+
+    def invalidate_prefix(self, *prefixes):
+        """ Drop every key that starts with one of prefixes, e.g. ("all_users",) for each page of users """
+        with self.lock:
+            self.generation += 1
+            for key in list(self.entries):
+                if any(key[:len(prefix)] == prefix for prefix in prefixes):
+                    del self.entries[key]
+
+    def clear(self):
+        with self.lock:
+            self.generation += 1
+            self.entries.clear()
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+
+            return {
+                "size": len(self.entries),
+                "max_entries": self.max_entries,
+                "ttl": self.ttl,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "evictions": self.evictions,
+                "expirations": self.expirations,
+            }
@@ -1,20 +1,45 @@
+import base64
 import os
+import time
 import arrow
 
-from flask import Flask, session, url_for, request, g, jsonify, json
+from functools import partial
 
+from flask import Flask, session, url_for, request, g, json, abort, Response
+
+from avatarstore import AvatarStore
 from database import Database
-from conversation import Conversation
+from message_writer import MessageWriter
+from conversation import Conversation, collect_new_messages, get_conversation_id_for_users
+from notifier import MessageNotifier
+from response_cache import ResponseCache
+import operations
+import wire_format
 
 
 app = Flask(__name__)
 app.config.from_object(__name__)
 
 app.secret_key = "tkinterguiprogrammingbyexample"
-
-database = Database()
-
-conversations_dir = os.path.abspath(os.path.join(os.path.dirname(__file__), 'conversations/'))
+# Flask answers anything bigger with 413 before it is read into memory
+app.config["MAX_CONTENT_LENGTH"] = AvatarStore.max_upload_bytes
+
+database = Database(pool_size=int(os.environ.get("CHAT_DB_POOL_SIZE", 5)))
+# messages get their own single connection that fsyncs each commit, shared by a whole batch
+message_writer = MessageWriter(
+    Database(pool_size=1, synchronous="FULL"),
+    flush_interval=float(os.environ.get("CHAT_FLUSH_INTERVAL", 0)),
+    max_batch=int(os.environ.get("CHAT_MAX_BATCH", 256)),
+)
+notifier = MessageNotifier()
+avatar_store = AvatarStore()
+response_cache = ResponseCache(
+    max_entries=int(os.environ.get("CHAT_CACHE_SIZE", 1024)),
+    ttl=float(os.environ.get("CHAT_CACHE_TTL", 60)),
+)
+
+MAX_WAIT_SECONDS = 60
+MAX_USERS_PAGE = 1000
 
 
 @app.route("/", methods=["GET"])
@@ -25,7 +50,7 @@ def index():
         "dogs": 4
     }
 
-    return jsonify(data)
+    return respond(data)
 
 
 @app.route("/send_me_data", methods=["POST"])
@@ -39,9 +64,15 @@ def send_me_data():
 
 @app.route("/get_all_users")
 def get_all_users():
-    all_users = database.get_all_users()
+    prefix = request.args.get("q", "")
+    after = request.args.get("after", "")
+    limit = min(int(request.args.get("limit", 100)), MAX_USERS_PAGE)
+
+    # one extra row tells us whether there is another page
+    search = partial(database.search_users, prefix, after, limit + 1)
+    users = response_cache.get_or_compute(("all_users", prefix, after, limit), search)
 
-    return jsonify(all_users)
+    return Response(operations.users_as_ndjson(users, limit), mimetype="application/x-ndjson")
 
 
 @app.route("/add_user", methods=["POST"])
@@ -51,8 +82,9 @@ def add_user():
     real_name = data["real_name"]
 
     database.add_user(username, real_name)
+    response_cache.invalidate_prefix(("all_users",))
 
-    return jsonify(
+    return respond(
         "User Created"
     )
 
@@ -62,36 +94,60 @@ def user_exists():
     username = request.form.get("username")
     exists = database.user_exists(username)
 
-    return jsonify({
+    return respond({
         "exists": exists
     })
 
 
-@app.route("/create_conversation_db", methods=["POST"])
-def create_conversation_db():
-    conversation_db_path = get_conversation_db_path_for_users(request.form)
+@app.route("/login", methods=["POST"])
+def login():
+    username = request.form.get("username")
+
+    return respond(operations.login(database, username))
+
+
+@app.route("/create_account", methods=["POST"])
+def create_account():
+    data = request.form
+    created = operations.create_account(database, data["username"], data["real_name"])
+    if created:
+        response_cache.invalidate_prefix(("all_users",))
+
+    return respond({
+        "created": created
+    })
+
+
+@app.route("/batch", methods=["POST"])
+def batch():
+    try:
+        operations_to_run = (request.get_json(silent=True) or {})["operations"]
+        results = operations.run_batch(database, operations_to_run)
+    except (KeyError, TypeError, ValueError) as e:
+        return respond({"error": str(e)}, 400)
 
-    if not os.path.exists(conversation_db_path):
-        with open(conversation_db_path, 'w') as f:
-            pass
-        conversation = Conversation(conversation_db_path)
-        conversation.initialise_table()
+    if operations.batch_writes(operations_to_run):
+        # working out exactly what a batch touched is not worth it for something this rare
+        response_cache.clear()
 
-    return jsonify({
+    return respond({
+        "results": results
+    })
+
+
+@app.route("/create_conversation_db", methods=["POST"])
+def create_conversation_db():
+    # all conversations share the messages table, so there is nothing to create
+    return respond({
         "success": True,
     })
 
 
 @app.route("/get_message_history", methods=["POST"])
 def get_message_history():
-    conversation_db_path = get_conversation_db_path_for_users(request.form)
-    conversation = Conversation(conversation_db_path)
-
-    history = conversation.get_history()
+    history = operations.get_message_history(database, request.form)
 
-    return jsonify({
-        "history": history
-    })
+    return respond(history)
 
 
 @app.route("/send_message/<username>", methods=["POST"])
@@ -101,48 +157,174 @@ def send_message(username):
     message = data["message"]
     date_sent = arrow.now().timestamp
 
-    conversation_db_path = get_conversation_db_path_for_users({"user_one": author, "user_two": username})
-    conversation = Conversation(conversation_db_path)
-    conversation.add_message(author, message, date_sent)
+    conversation_id = get_conversation_id_for_users({"user_one": author, "user_two": username})
+    # returns only once the batch holding this message is committed
+    message_id = message_writer.write(conversation_id, author, message, date_sent)
+    notifier.notify(username)
 
-    return jsonify({
-        "success": True
+    return respond({
+        "success": True,
+        "id": message_id,
     })
 
 
 @app.route("/update_avatar/<username>", methods=["POST"])
 def update_avatar(username):
-    img_b64 = request.form.get("img_b64")
-    database.update_avatar(username, img_b64)
-
-    return jsonify({
-        "success": True
+    try:
+        if request.mimetype == "image/png":
+            image_bytes = request.get_data()
+        elif "avatar" in request.files:
+            image_bytes = request.files["avatar"].read()
+        else:
+            # older clients send the image as a base64 form field
+            image_bytes = base64.urlsafe_b64decode(request.form["img_b64"])
+
+        avatar_hash = avatar_store.save(image_bytes)
+    except (KeyError, ValueError) as e:
+        return respond({"error": str(e)}, 400)
+
+    database.update_avatar(username, avatar_hash)
+    invalidate_user(username)
+
+    return respond({
+        "success": True,
+        "avatar_hash": avatar_hash,
     })
 
 
 @app.route("/get_user_avatar/<username>")
 def get_avatar(username):
+    results = response_cache.get_or_compute(("avatar", username), partial(database.get_user_avatar, username))
+    avatar = results[0] if results else {"avatar_hash": None}
 
-    avatar_b64 = database.get_user_avatar(username)['avatar']
+    response = respond(avatar)
+    if avatar["avatar_hash"]:
+        # clients send back the hash they hold as If-None-Match and get an empty 304 if it is current
+        response.set_etag(avatar["avatar_hash"])
+        response = response.make_conditional(request)
 
-    return jsonify({
-        "avatar": avatar_b64
-    })
+    return response
+
+
+@app.route("/avatar/<avatar_hash>")
+def get_avatar_image(avatar_hash):
+    """ ?size=32, 64 or 128 gets a copy shrunk to fit, so clients fetch only the pixels they draw """
+    size = request.args.get("size")
+
+    if not avatar_store.is_valid_hash(avatar_hash):
+        abort(404)
+
+    if size is not None:
+        # checked as a string, as type=int would turn ?size=abc into no size and serve the original
+        if not size.isdigit() or int(size) not in avatar_store.sizes:
+            abort(404)
+        size = int(size)
+
+    try:
+        path = avatar_store.path(avatar_hash) if size is None else avatar_store.sized_path(avatar_hash, size)
+        with open(path, "rb") as avatar_file:
+            image_bytes = avatar_file.read()
+    except OSError:
+        # missing, or an original saved before uploads were checked that cannot be resized
+        abort(404)
+
+    response = app.response_class(image_bytes, mimetype="image/png")
+
+    # the hash is the content, so this URL can never change
+    response.cache_control.public = True
+    response.cache_control.max_age = 31536000
+    response.set_etag(avatar_hash if size is None else f"{avatar_hash}-{size}")
+
+    return response.make_conditional(request, accept_ranges=True, complete_length=len(image_bytes))
 
 
 @app.route("/get_new_messages", methods=["POST"])
 def get_new_messages():
     data = request.form
-    conversation_db_path = get_conversation_db_path_for_users(data)
-    conversation_db = Conversation(conversation_db_path)
+    conversation_id = get_conversation_id_for_users(data)
+    conversation = Conversation(database, conversation_id)
 
-    timestamp = data["timestamp"]
     requester_username = data["user_one"]
 
-    new_messages = conversation_db.get_new_messages(timestamp, requester_username)
+    if "after_id" in data:
+        after_id = int(data["after_id"])
+        messages = conversation.get_messages_after(after_id)
+        last_id = messages[-1]["id"] if messages else after_id
+        new_messages = [message for message in messages if message["author"] != requester_username]
+    else:
+        new_messages = conversation.get_new_messages(data["timestamp"], requester_username)
+        last_id = new_messages[-1]["id"] if new_messages else None
 
-    return jsonify({
-        "messages": new_messages
+    return respond({
+        "messages": new_messages,
+        "last_id": last_id,
+    })
+
+
+@app.route("/wait_for_messages", methods=["POST"])
+def wait_for_messages():
+    data = request.form
+    conversation_id = get_conversation_id_for_users(data)
+    conversation = Conversation(database, conversation_id)
+
+    requester_username = data["user_one"]
+    last_id = int(data["after_id"])
+    timeout = min(float(data.get("timeout", 25)), MAX_WAIT_SECONDS)
+    deadline = time.monotonic() + timeout
+
+    while True:
+        # read the version first so a message sent during the query still wakes us
+        version = notifier.version(requester_username)
+        messages = conversation.get_messages_after(last_id)
+        if messages:
+            last_id = messages[-1]["id"]
+
+        new_messages = [message for message in messages if message["author"] != requester_username]
+        remaining = deadline - time.monotonic()
+
+        if new_messages or remaining <= 0:
+            break
+
+        notifier.wait(requester_username, version, remaining)
+
+    return respond({
+        "messages": new_messages,
+        "last_id": last_id,
+    })
+
+
+@app.route("/wait_for_messages_batch", methods=["POST"])
+def wait_for_messages_batch():
+    """ One long-poll covering every conversation the client has open """
+    data = request.get_json()
+    requester_username = data["username"]
+    timeout = min(float(data.get("timeout", 25)), MAX_WAIT_SECONDS)
+
+    friends_by_conversation = {}
+    cursors = {}
+    for friend, after_id in data["conversations"].items():
+        conversation_id = get_conversation_id_for_users({"user_one": requester_username, "user_two": friend})
+        friends_by_conversation[conversation_id] = friend
+        cursors[conversation_id] = int(after_id)
+
+    version = notifier.version(requester_username)
+    new_messages = collect_new_messages(database, requester_username, cursors)
+
+    # any notification ends the wait, even for a conversation that is not in this batch,
+    # so the client can re-subscribe with a window it opened while we were waiting
+    if not any(new_messages.values()):
+        notifier.wait(requester_username, version, timeout)
+        new_messages = collect_new_messages(database, requester_username, cursors)
+
+    conversations = {}
+    for conversation_id, friend in friends_by_conversation.items():
+        conversations[friend] = {
+            "messages": new_messages[conversation_id],
+            "last_id": cursors[conversation_id],
+        }
+
+    return respond({
+        "conversations": conversations
     })
 
 
@@ -152,13 +334,11 @@ def add_friend():
     user_one = data['user_one']
     user_two = data['user_two']
 
-    if database.user_exists(user_two) and database.user_exists(user_one):
-        database.add_friend(user_one, user_two)
-        success = True
-    else:
-        success = False
+    success = operations.add_friend(database, user_one, user_two)
+    if success:
+        response_cache.invalidate(("friends", user_one), ("friends", user_two))
 
-    return jsonify({
+    return respond({
         "success": success
     })
 
@@ -170,37 +350,45 @@ def block_friend():
     user_two = data['user_two']
 
     database.block_friend(user_one, user_two)
+    response_cache.invalidate(("friends", user_one), ("friends", user_two))
 
-    return jsonify({
+    return respond({
         "success": True
     })
 
 
 @app.route("/get_friends/<username>")
 def get_friends(username):
-    friends = database.get_friends(username)
+    since = request.args.get("since")
 
-    if len(friends):
-        all_friends = database.get_users_by_usernames(friends)
-    else:
-        all_friends = []
+    if since is not None:
+        return respond(operations.get_friends_delta(database, username, since))
 
-    return jsonify({
-        "friends": all_friends
-    })
+    friends_list = response_cache.get_or_compute(("friends", username), partial(operations.get_friends_list, database, username))
+
+    return respond(friends_list)
+
+
+@app.route("/cache_stats")
+def cache_stats():
+    return respond(response_cache.stats())
+
+
+def respond(data, status=200):
+    """ Like jsonify, but as MessagePack and/or compressed when the request's Accept headers allow it """
+    body, headers = wire_format.encode(data, request.headers.get("Accept", ""), request.headers.get("Accept-Encoding", ""))
 
+    return app.response_class(body, status=status, headers=headers)
 
-def get_conversation_db_path_for_users(data):
-    user_one = data["user_one"]
-    user_two = data["user_two"]
 
-    users_in_order = sorted([user_one, user_two])
-    users_in_order = "_".join(users_in_order)
+def invalidate_user(username):
+    """ Drop every cached response that shows username's avatar """
+    keys = [("avatar", username)]
+    keys.extend(("friends", friend) for friend in database.get_friends(username))
 
-    conversation_db = users_in_order + ".db"
-    conversation_db_path = os.path.join(conversations_dir, conversation_db)
+    response_cache.invalidate(*keys)
+    response_cache.invalidate_prefix(("all_users",))
 
-    return conversation_db_path
 
 if __name__ == '__main__':
-    app.run(debug=True)
+    app.run(debug=True, threaded=True)
@@ -0,0 +1,156 @@
+import base64
+import hashlib
+import sqlite3
+import sys
+
+from avatarstore import AvatarStore
+from create_database import friends_index_sql, messages_sql
+
+
+def get_columns(cursor, table):
+    cursor.execute(f"PRAGMA table_info({table})")
+
+    return [row[1] for row in cursor.fetchall()]
+
+
+def upgrade_messages_table(cursor):
+    """ Rebuild messages with an integer id and date_sent, ordering old rows by when they were sent """
+    columns = get_columns(cursor, "messages")
+    if "id" in columns:
+        return False
+
+    # databases from before the shared messages table have nothing to rebuild
+    if not columns:
+        for sql in messages_sql:
+            cursor.execute(sql)
+        return True
+
+    cursor.execute("ALTER TABLE messages RENAME TO messages_old")
+    cursor.execute("DROP INDEX IF EXISTS messages_conversation_date")
+    cursor.execute("CREATE TABLE messages (id INTEGER PRIMARY KEY, conversation_id TEXT, author TEXT, message TEXT, date_sent INTEGER)")
+    cursor.execute(
+        "INSERT INTO messages (conversation_id, author, message, date_sent) "
+        "SELECT conversation_id, author, message, CAST(date_sent AS INTEGER) FROM messages_old "
+        "ORDER BY CAST(date_sent AS INTEGER), rowid"
+    )
+    cursor.execute("DROP TABLE messages_old")
+    cursor.execute("CREATE INDEX messages_conversation_id ON messages (conversation_id, id)")
+    cursor.execute("CREATE INDEX messages_conversation_date ON messages (conversation_id, date_sent)")
+
+    return True
+
+
+def add_avatar_hashes(cursor):
+    if "avatar_hash" in get_columns(cursor, "users"):
+        return False
+
+    cursor.execute("ALTER TABLE users ADD COLUMN avatar_hash TEXT")
+    cursor.execute("SELECT rowid, avatar FROM users WHERE avatar IS NOT NULL")
+    for rowid, avatar in cursor.fetchall():
+        try:
+            avatar_hash = hashlib.sha256(base64.urlsafe_b64decode(avatar)).hexdigest()
+        except ValueError:
+            # move_avatars_to_files clears an avatar that is not valid base64
+            continue
+        cursor.execute("UPDATE users SET avatar_hash=? WHERE rowid=?", (avatar_hash, rowid))
+
+    return True
+
+
+def move_avatars_to_files(cursor):
+    """ Decode base64 avatars out of the users table into the content-addressed AvatarStore """
+    if "avatar" not in get_columns(cursor, "users"):
+        return False
+
+    cursor.execute("SELECT rowid, avatar FROM users WHERE avatar IS NOT NULL")
+    rows = cursor.fetchall()
+    if not rows:
+        return False
+
+    avatar_store = AvatarStore()
+    for rowid, avatar in rows:
+        try:
+            avatar_hash = avatar_store.save(base64.urlsafe_b64decode(avatar))
+        except ValueError as e:
+            # one broken avatar should not stop the upgrade; its user goes back to the default
+            print(f"Dropped the avatar of user {rowid}: {e}")
+            avatar_hash = None
+
+        cursor.execute("UPDATE users SET avatar=NULL, avatar_hash=? WHERE rowid=?", (avatar_hash, rowid))
+
+    return True
+
+
+def add_friend_changes_table(cursor):
+    cursor.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='friend_changes'")
+    if cursor.fetchone():
+        return False
+
+    cursor.execute("CREATE TABLE friend_changes (id INTEGER PRIMARY KEY, username TEXT, friend TEXT)")
+    cursor.execute("CREATE INDEX friend_changes_username ON friend_changes (username, id)")
+
+    return True
+
+
+def index_friends(cursor):
+    """ Merge duplicate friendship rows and add the lookup and uniqueness indexes """
+    cursor.execute("SELECT name FROM sqlite_master WHERE type='index' AND name='friends_pair'")
+    if cursor.fetchone():
+        return False
+
+    # a pair counted as friends if any of its rows was unblocked, so keep that state on the surviving row
+    cursor.execute(
+        "UPDATE friends SET blocked = ("
+        "SELECT MIN(duplicate.blocked) FROM friends AS duplicate "
+        "WHERE min(duplicate.user_one, duplicate.user_two) = min(friends.user_one, friends.user_two) "
+        "AND max(duplicate.user_one, duplicate.user_two) = max(friends.user_one, friends.user_two))"
+    )
+    cursor.execute(
+        "DELETE FROM friends WHERE rowid NOT IN ("
+        "SELECT MIN(rowid) FROM friends GROUP BY min(user_one, user_two), max(user_one, user_two))"
+    )
+
+    for sql in friends_index_sql:
+        cursor.execute(sql)
+    cursor.execute("CREATE INDEX IF NOT EXISTS users_username ON users (username)")
+
+    return True
+
+
+def index_real_names(cursor):
+    cursor.execute("SELECT name FROM sqlite_master WHERE type='index' AND name='users_real_name'")
+    if cursor.fetchone():
+        return False
+
+    cursor.execute("CREATE INDEX users_real_name ON users (real_name COLLATE NOCASE)")
+
+    return True
+
+
+upgrades = [
+    upgrade_messages_table,
+    add_avatar_hashes,
+    move_avatars_to_files,
+    add_friend_changes_table,
+    index_friends,
+    index_real_names,
+]
+
+
+def upgrade_database(path="chat.db"):
+    database = sqlite3.connect(path)
+
+    try:
+        cursor = database.cursor()
+
+        for upgrade in upgrades:
+            if upgrade(cursor):
+                print("Applied", upgrade.__name__)
+
+        database.commit()
+    finally:
+        database.close()
+
+
+if __name__ == '__main__':
+    upgrade_database(sys.argv[1] if len(sys.argv) > 1 else "chat.db")
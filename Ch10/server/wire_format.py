@@ -0,0 +1,47 @@
+import gzip
+import json
+import zlib
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+
+JSON_TYPE = "application/json"
+MSGPACK_TYPE = "application/msgpack"
+
+# below this a compressed body is barely smaller and costs more CPU than it saves on the wire
+MIN_COMPRESS_SIZE = 512
+
+
+def accepts(header, value):
+    """ Whether a comma separated Accept or Accept-Encoding header lists value without q=0 """
+    for item in header.split(","):
+        name, *options = [part.strip() for part in item.split(";")]
+        if name.lower() == value:
+            return not any(option.replace(" ", "") in ("q=0", "q=0.0") for option in options)
+
+    return False
+
+
+def encode(data, accept="", accept_encoding=""):
+    """ Returns (body, headers) for data in the most compact format and encoding the client accepts """
+    if msgpack is not None and accepts(accept, MSGPACK_TYPE):
+        body = msgpack.packb(data, use_bin_type=True)
+        content_type = MSGPACK_TYPE
+    else:
+        body = json.dumps(data, separators=(",", ":")).encode()
+        content_type = JSON_TYPE
+
+    headers = {"Content-Type": content_type, "Vary": "Accept, Accept-Encoding"}
+
+    if len(body) >= MIN_COMPRESS_SIZE:
+        if accepts(accept_encoding, "gzip"):
+            body = gzip.compress(body, compresslevel=6)
+            headers["Content-Encoding"] = "gzip"
+        elif accepts(accept_encoding, "deflate"):
+            body = zlib.compress(body, 6)
+            headers["Content-Encoding"] = "deflate"
+
+    return body, headers
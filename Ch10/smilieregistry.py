@@ -0,0 +1,106 @@
+import json
+import os
+import re
+
+import tkinter as tk
+
+
+class SmilieRegistry:
+    """ Decodes each smilie once per process and shares the PhotoImage with every window that shows it """
+
+    smilies_dir = os.path.abspath(os.path.join(os.path.dirname(__file__), 'smilies/'))
+    prefix = "mikulka-smile-"
+
+    def __init__(self):
+        self.images = {}
+        self.names = None
+        self.token_pattern = None
+
+        # made by build_smilie_atlas.py; without it each smilie is loaded from its own file
+        self.atlas_path = os.path.join(self.smilies_dir, "atlas.png")
+        self.atlas_index_path = os.path.join(self.smilies_dir, "atlas.json")
+        self.atlas = None
+        self.atlas_index = None
+
+    def load_atlas_index(self):
+        if self.atlas_index is None:
+            try:
+                with open(self.atlas_index_path) as index_file:
+                    self.atlas_index = json.load(index_file)
+            except FileNotFoundError:
+                self.atlas_index = {}
+
+        return self.atlas_index
+
+    def get_names(self):
+        """ Short names such as "cool", in picker order """
+        if self.names is None:
+            atlas_index = self.load_atlas_index()
+
+            if atlas_index:
+                self.names = sorted(atlas_index)
+            else:
+                files = sorted(file for file in os.listdir(self.smilies_dir) if file.startswith(self.prefix) and file.endswith(".png"))
+                self.names = [file[len(self.prefix):-len(".png")] for file in files]
+
+        return self.names
+
+    def get(self, name):
+        """ The PhotoImage for name, or None for a name we do not have """
+        if name in self.images:
+            return self.images[name]
+
+        if name not in self.get_names():
+            return None
+
+        atlas_index = self.load_atlas_index()
+
+        if atlas_index:
+            if self.atlas is None:
+                self.atlas = tk.PhotoImage(file=self.atlas_path)
+
+            x, y, width, height = atlas_index[name]
+            image = tk.PhotoImage(width=width, height=height)
+            image.tk.call(image, "copy", self.atlas, "-from", x, y, x + width, y + height)
+        else:
+            image = tk.PhotoImage(file=os.path.join(self.smilies_dir, f"{self.prefix}{name}.png"))
+
+        self.images[name] = image
+
+        return image
+
+    def get_all(self):
+        return [(name, self.get(name)) for name in self.get_names()]
+
+    def token(self, name):
+        """ How a smilie travels inside a message body, e.g. :cool: """
+        return f":{name}:"
+
+    def expand(self, text):
+        """ Takes the tokens out of text, returning the plain text and an (offset, image) for each smilie to put back """
+        if self.token_pattern is None:
+            names = "|".join(re.escape(name) for name in self.get_names())
+            self.token_pattern = re.compile(f":({names}):")
+
+        plain_parts = []
+        images = []
+        offset = 0
+        last_end = 0
+
+        for match in self.token_pattern.finditer(text):
+            plain = text[last_end:match.start()]
+            plain_parts.append(plain)
+            offset += len(plain)
+
+            # each image takes up one character, so offsets already count the images before it
+            images.append((offset, self.get(match.group(1))))
+            offset += 1
+            last_end = match.end()
+
+        plain_parts.append(text[last_end:])
+
+        return "".join(plain_parts), images
+
+
+# PhotoImages need a Tk root, so nothing is decoded until the first get
+smilies = SmilieRegistry()
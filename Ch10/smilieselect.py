@@ -1,30 +1,22 @@
-import os
-
 import tkinter as tk
 import tkinter.ttk as ttk
 
+from smilieregistry import smilies
 
-class SmilieSelect(tk.Toplevel):
-    smilies_dir = os.path.abspath(os.path.join(os.path.dirname(__file__), 'smilies/'))
 
+class SmilieSelect(tk.Toplevel):
     def __init__(self, master, **kwargs):
         super().__init__(**kwargs)
         self.master = master
         self.transient(master)
         self.position_window()
 
-        smilie_files = [file for file in os.listdir(self.smilies_dir) if file.endswith(".png")]
-
-        self.smilie_images = []
-
-        for file in smilie_files:
-            full_path = os.path.join(self.smilies_dir, file)
-            image = tk.PhotoImage(file=full_path)
-            self.smilie_images.append(image)
+        # decoded once and shared, so only the first picker opened reads from disk
+        self.smilie_images = smilies.get_all()
 
-        for index, file in enumerate(self.smilie_images):
+        for index, (name, image) in enumerate(self.smilie_images):
             row, col = divmod(index, 3)
-            button = ttk.Button(self, image=file, command=lambda s=file: self.insert_smilie(s))
+            button = ttk.Button(self, image=image, command=lambda s=name: self.insert_smilie(s))
             button.grid(row=row, column=col, sticky='nsew')
 
         for i in range(3):